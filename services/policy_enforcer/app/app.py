@@ -1,41 +1,167 @@
+import asyncio
+import hmac
 import logging
-from typing import Any, Dict
+import math
+import os
+import signal
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict
 
-import httpx
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, StreamingResponse, RedirectResponse
+from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html, get_swagger_ui_oauth2_redirect_html
+from fastapi.openapi.utils import get_openapi
+from fastapi.responses import JSONResponse, Response, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from . import config
 from .policies.enforcer import EnforceResult, RequestEnforcer
-from .scheme_builder import SchemeBuilder
+from .policies.rate_limit import MAX_RETRY_AFTER
+from .batch import BATCH_PATH, BatchDispatcher, BatchRequest, BatchResponse
+from .coalescing import Coalescer
+from .compression import CompressionMiddleware, matching_etag
+from .logs import AccessLogMiddleware, setup_logging
+from .metrics import CONTENT_TYPE, REGISTRY, Collected, MetricsMiddleware
+from .proxy import Proxy
+from .response_cache import ResponseCache
+from .scheme_builder import SchemeCache
+from .upstream import UpstreamPool
+
+app_config: config.Config = config.load_config(_env_file='.env')
 
 # setup logging
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.INFO,            
-    format="[%(levelname)s][%(name)s][%(filename)s, line %(lineno)d]: %(message)s"
-)
-
-app_config: config.Config = config.load_config(_env_file='.env')
+# httpx logs every upstream request at info level
+setup_logging(app_config.log_level, app_config.log_sample_rate, {'httpx': logging.WARNING})
 
 policy_checker: RequestEnforcer = RequestEnforcer(
-    app_config.policies_config_path, app_config.jwt_secret.get_secret_value()
+    app_config.policies_config_path, app_config.jwt_secret.get_secret_value(),
+    decision_cache_size=app_config.decision_cache_size,
+    decision_cache_ttl=app_config.decision_cache_ttl,
+    token_cache_size=app_config.token_cache_size,
+    rate_limit_buckets=app_config.rate_limit_buckets,
+    policy_engine=app_config.policy_engine,
 )
 logger.info(f"Policy services loaded: {policy_checker.services}")
 
+upstream_pool: UpstreamPool = UpstreamPool(app_config.upstream_drain_timeout)
+policy_checker.endpoint_selector = upstream_pool.select
+scheme_cache: SchemeCache = SchemeCache(app_config.openapi_fetch_timeout)
+response_cache: ResponseCache = ResponseCache(
+    app_config.response_cache_max_bytes, app_config.response_cache_max_entry_bytes
+)
+coalescer: Coalescer = Coalescer(app_config.coalesce_max_body_size)
+proxy: Proxy = Proxy(
+    upstream_pool, response_cache, coalescer,
+    app_config.max_request_body_size, app_config.request_body_buffer_size
+)
+
+
+
+def collect_cache_requests():
+    caches = {
+        'decision': policy_checker.decision_cache.stats(),
+        'token': policy_checker.token_cache.stats(),
+        'response': response_cache.stats(),
+    }
+    for cache, stats in caches.items():
+        yield (cache, 'hit'), stats['hits']
+        yield (cache, 'miss'), stats['misses']
+
+
+def collect_upstream(field: str):
+    def collect():
+        for service, stats in upstream_pool.stats().items():
+            yield (service,), stats[field]
+    return collect
+
+
+REGISTRY.register(Collected(
+    'gateway_cache_requests_total', 'Cache lookups by cache and result', 'counter',
+    ('cache', 'result'), collect_cache_requests,
+))
+REGISTRY.register(Collected(
+    'gateway_upstream_retries_total', 'Retried upstream calls', 'counter',
+    ('service',), collect_upstream('retries'),
+))
+REGISTRY.register(Collected(
+    'gateway_upstream_hedges_total', 'Hedged upstream calls', 'counter',
+    ('service',), collect_upstream('hedges'),
+))
+REGISTRY.register(Collected(
+    'gateway_upstream_in_flight', 'Requests in flight to upstream', 'gauge',
+    ('service',), collect_upstream('in_flight'),
+))
+
+
+async def refresh_openapi_periodically(app: "App"):
+    while True:
+        try:
+            await app.refresh_openapi()
+        except Exception as E:
+            logger.error(f"Error occured in openapi refresh: {E}")
+        await asyncio.sleep(app_config.openapi_refresh_interval)
+
+
+async def reload_policies(app: "App"):
+    await policy_checker.reload()
+    upstream_pool.sync(policy_checker.services)
+    await app.refresh_openapi()
+
+
+async def reload_on_signal(app: "App"):
+    try:
+        await reload_policies(app)
+    except Exception as E:
+        logger.error(f"Error occured in policies reload, keeping previous policies: {E}")
+
+
+async def watch_policies(app: "App"):
+    while True:
+        await asyncio.sleep(app_config.policies_reload_interval)
+        if not policy_checker.config_changed():
+            continue
+        try:
+            await reload_policies(app)
+        except Exception as E:
+            logger.error(f"Error occured in policies reload, keeping previous policies: {E}")
+
+
+@asynccontextmanager
+async def lifespan(app: "App"):
+    upstream_pool.open(policy_checker.services)
+    tasks = [asyncio.create_task(refresh_openapi_periodically(app))]
+    if app_config.policies_reload_interval > 0:
+        tasks.append(asyncio.create_task(watch_policies(app)))
+    # SIGHUP reloads policies, app.serve master sends it to every worker on POST /gateway/reload
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, lambda: tasks.append(asyncio.create_task(reload_on_signal(app))))
+    yield
+    loop.remove_signal_handler(signal.SIGHUP)
+    for task in tasks:
+        task.cancel()
+    await upstream_pool.close()
+
 
 class App(FastAPI):
     def openapi(self) -> Dict[str, Any]:
-        scheme_builder = SchemeBuilder(super().openapi())
+        if scheme_cache.result is None:
+            return self.gateway_openapi()
+        return scheme_cache.result
+
+    def gateway_openapi(self) -> Dict[str, Any]:
+        return get_openapi(
+            title=self.title,
+            version=self.version,
+            openapi_version=self.openapi_version,
+            routes=self.routes,
+        )
 
-        for target in policy_checker.services:
-            resp = httpx.get(target.openapi_scheme)
-            scheme_builder.append(resp.json(), inject_token_in_swagger=target.inject_token_in_swagger)
-        return scheme_builder.result
+    async def refresh_openapi(self) -> None:
+        await scheme_cache.refresh(self.gateway_openapi(), policy_checker.services, upstream_pool)
 
 
-app = App()
+#openapi and docs routes are served from scheme cache below
+app = App(lifespan=lifespan, openapi_url=None, docs_url=None, redoc_url=None)
 
 origins = [
     "http://localhost",
@@ -43,6 +169,8 @@ origins = [
     "http://localhost:5020",
 ]
 
+app.add_middleware(CompressionMiddleware, min_size=app_config.compression_min_size)
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -50,6 +178,118 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(AccessLogMiddleware)
+
+@app.get("/openapi.json", include_in_schema=False)
+async def openapi_json(request: Request):
+    if scheme_cache.body is None:
+        await app.refresh_openapi()
+
+    headers = {'ETag': scheme_cache.etag, 'Cache-Control': 'no-cache'}
+    matched = matching_etag(request.headers.get('if-none-match'), scheme_cache.etag)
+    if matched is not None:
+        return Response(status_code=304, headers={**headers, 'ETag': matched})
+    return Response(scheme_cache.body, media_type='application/json', headers=headers)
+
+@app.get("/docs", include_in_schema=False)
+async def swagger_ui_html():
+    return get_swagger_ui_html(
+        openapi_url='/openapi.json',
+        title=f'{app.title} - Swagger UI',
+        oauth2_redirect_url='/docs/oauth2-redirect',
+    )
+
+@app.get("/docs/oauth2-redirect", include_in_schema=False)
+async def swagger_ui_redirect():
+    return get_swagger_ui_oauth2_redirect_html()
+
+@app.get("/redoc", include_in_schema=False)
+async def redoc_html():
+    return get_redoc_html(openapi_url='/openapi.json', title=f'{app.title} - ReDoc')
+
+def is_admin(request: Request) -> bool:
+    '''
+    Request carries GATEWAY_ADMIN_TOKEN in X-Admin-Token or as bearer token (as Prometheus sends it),
+    gateway endpoints are not served at all without the setting
+    '''
+    admin_token = app_config.admin_token
+    if admin_token is None:
+        return False
+    token = request.headers.get('x-admin-token')
+    if token is None:
+        scheme, _, token = request.headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'bearer':
+            return False
+    return hmac.compare_digest(token.strip().encode(), admin_token.get_secret_value().encode())
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    if not is_admin(request):
+        return JSONResponse(content={'message': 'Content not found'}, status_code=404)
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
+@app.get("/gateway/stats", include_in_schema=False)
+async def gateway_stats(request: Request):
+    if not is_admin(request):
+        return JSONResponse(content={'message': 'Content not found'}, status_code=404)
+    return {
+        'worker': os.getpid(),
+        'upstream_pools': upstream_pool.stats(),
+        'decision_cache': policy_checker.decision_cache.stats(),
+        'policy_engine': policy_checker.engine_stats,
+        'token_cache': policy_checker.token_cache.stats(),
+        'response_cache': response_cache.stats(),
+        'rate_limiter': policy_checker.rate_limiter.stats(),
+        'coalescing': coalescer.stats(),
+        'batch': batch_dispatcher.stats(),
+    }
+
+# set by app.serve, tells the other workers to reload policies as well
+reload_broadcast: Callable[[], None] | None = None
+
+@app.post("/gateway/reload", include_in_schema=False)
+async def gateway_reload(request: Request):
+    if not is_admin(request):
+        return JSONResponse(content={'message': 'Content not found'}, status_code=404)
+
+    try:
+        await reload_policies(app)
+    except Exception as E:
+        logger.error(f"Error occured in policies reload, keeping previous policies: {E}")
+        return JSONResponse(content={'message': f'Policies not reloaded: {E}'}, status_code=400)
+    if reload_broadcast is not None:
+        reload_broadcast()
+    return {'message': 'Policies reloaded', 'services': [s.name for s in policy_checker.services]}
+
+async def enforce_and_forward(request: Request) -> Response:
+    enforce_result: EnforceResult = await policy_checker.enforce(request)
+    request.state.metrics_labels = (enforce_result.service_name or '', enforce_result.route)
+    if enforce_result.retry_after is not None:
+        return JSONResponse(
+            content={'message': 'Too many requests'}, status_code=429,
+            headers={'Retry-After': str(max(math.ceil(min(enforce_result.retry_after, MAX_RETRY_AFTER)), 1))},
+        )
+    if not enforce_result.access_allowed:
+        return JSONResponse(content={'message': 'Content not found'}, status_code=404)
+
+    return await proxy.forward(request, enforce_result)
+
+batch_dispatcher: BatchDispatcher = BatchDispatcher(
+    enforce_and_forward, app_config.batch_parallelism, app_config.batch_max_requests,
+    app_config.batch_max_item_bytes, app_config.batch_max_bytes,
+)
+
+@app.post(BATCH_PATH, response_model=BatchResponse)
+async def batch(request: Request, batch_request: BatchRequest):
+    '''
+    Several requests in one round trip, every one is checked by policies and proxied as if sent alone
+    '''
+    request.state.metrics_labels = ('', BATCH_PATH)
+    if len(batch_request.requests) > batch_dispatcher.max_requests:
+        return JSONResponse(
+            content={'message': f'At most {batch_dispatcher.max_requests} requests in batch'}, status_code=413
+        )
+    return BatchResponse(responses=await batch_dispatcher.run(request, batch_request))
 
 @app.api_route("/{path_name:path}", methods=["GET", "DELETE", "PATCH", "POST", "PUT", "HEAD", "OPTIONS", "CONNECT", "TRACE"])
 async def catch_all(request: Request, path_name: str):
@@ -57,20 +297,4 @@ async def catch_all(request: Request, path_name: str):
     if path_name == "": #redirect to docs if no path
         return RedirectResponse(url='/docs')
 
-    enforce_result: EnforceResult = await policy_checker.enforce(request)
-    if not enforce_result.access_allowed:
-        return JSONResponse(content={'message': 'Content not found'}, status_code=404)
-    
-    client = httpx.AsyncClient(base_url=enforce_result.redirect_service)
-    url = httpx.URL(path=request.url.path,
-                    query=request.url.query.encode("utf-8"))
-    rp_req = client.build_request(request.method, url,
-                                  headers=request.headers.raw,
-                                  content=await request.body())
-    rp_resp = await client.send(rp_req, stream=True)
-    
-    return StreamingResponse(
-        rp_resp.aiter_raw(),
-        status_code=rp_resp.status_code,
-        headers=rp_resp.headers
-    )
\ No newline at end of file
+    return await enforce_and_forward(request)
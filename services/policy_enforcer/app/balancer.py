@@ -0,0 +1,118 @@
+import itertools
+import random
+
+from .policies.config import CircuitBreakerSettings, Service
+from .resilience import OPEN, CircuitBreaker, LatencyTracker
+
+
+class Endpoint:
+    '''
+    One upstream instance of a service
+    '''
+
+    def __init__(self, url: str, breaker_settings: CircuitBreakerSettings = CircuitBreakerSettings()) -> None:
+        self.url: str = url
+        self.outstanding: int = 0
+        self.healthy: bool = True
+        self.failures: int = 0
+        self.successes: int = 0
+        self.breaker: CircuitBreaker = CircuitBreaker(breaker_settings)
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.breaker.state != OPEN
+
+    def stats(self) -> dict:
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'circuit': self.breaker.state,
+            'circuit_opened': self.breaker.opened,
+            'outstanding': self.outstanding,
+        }
+
+
+class RoundRobin:
+    def __init__(self) -> None:
+        self.__counter = itertools.count()
+
+    def pick(self, endpoints: list[Endpoint]) -> Endpoint:
+        return endpoints[next(self.__counter) % len(endpoints)]
+
+
+class LeastOutstanding:
+    def pick(self, endpoints: list[Endpoint]) -> Endpoint:
+        return min(endpoints, key=lambda e: e.outstanding)
+
+
+class PowerOfTwoChoices:
+    def pick(self, endpoints: list[Endpoint]) -> Endpoint:
+        if len(endpoints) == 1:
+            return endpoints[0]
+        first, second = random.sample(endpoints, 2)
+        return first if first.outstanding <= second.outstanding else second
+
+
+BALANCERS = {
+    'round_robin': RoundRobin,
+    'least_outstanding': LeastOutstanding,
+    'p2c': PowerOfTwoChoices,
+}
+
+
+class ServiceEndpoints:
+    '''
+    Endpoints of one service with its balancing strategy.
+    Unhealthy endpoints and endpoints with open circuit are skipped unless none are left.
+    '''
+
+    def __init__(self, service: Service) -> None:
+        self.service: Service = service
+        self.endpoints: list[Endpoint] = [Endpoint(url, service.circuit_breaker) for url in service.endpoints]
+        self.by_url: dict[str, Endpoint] = {e.url: e for e in self.endpoints}
+        self.balancer = BALANCERS[service.balancer]()
+        self.max_concurrency: int = service.max_concurrency
+        self.latency: LatencyTracker = LatencyTracker()
+        self.rejected: int = 0
+        self.retries: int = 0
+        self.hedges: int = 0
+        self.hedge_wins: int = 0
+
+    @property
+    def in_flight(self) -> int:
+        return sum(e.outstanding for e in self.endpoints)
+
+    @property
+    def saturated(self) -> bool:
+        return self.max_concurrency > 0 and self.in_flight >= self.max_concurrency
+
+    def pick(self, exclude: set[str] = frozenset()) -> Endpoint | None:
+        '''
+        Next endpoint by balancing strategy, None if all endpoints are excluded
+        '''
+        candidates = [e for e in self.endpoints if e.url not in exclude]
+        if not candidates:
+            return None
+        available = [e for e in candidates if e.available]
+        return self.balancer.pick(available or candidates)
+
+    def hedge_delay(self) -> float | None:
+        '''
+        Seconds to wait for response before sending second request, None when hedging is off
+        '''
+        settings = self.service.hedge
+        if not settings.enabled or len(self.endpoints) < 2 or len(self.latency) < settings.min_samples:
+            return None
+        return max(self.latency.percentile(settings.percentile), settings.min_delay)
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency,
+            'rejected': self.rejected,
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'latency_p50': self.latency.percentile(50),
+            'latency_p95': self.latency.percentile(95),
+        }
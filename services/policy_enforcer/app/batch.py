@@ -0,0 +1,219 @@
+import asyncio
+import json
+import logging
+import urllib.parse
+from typing import Any, Awaitable, Callable, Literal
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
+
+logger = logging.getLogger("policy-enforcement-service")
+
+BATCH_PATH = '/batch'
+# batch request headers not passed to sub-requests, they describe batch body
+BODY_HEADERS = {b'content-length', b'content-type', b'transfer-encoding', b'content-encoding', b'expect'}
+# sub-request responses are embedded in json, so they have to come uncompressed
+SUB_REQUEST_HEADERS = [(b'accept-encoding', b'identity')]
+NOT_RETURNED_HEADERS = {'content-length', 'transfer-encoding', 'connection', 'keep-alive'}
+
+
+class BatchItem(BaseModel):
+    method: Literal['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE'] = 'GET'
+    path: str #with query string, e.g. /todo/sections?limit=10
+    headers: dict[str, str] = {} #added to headers of batch request, e.g. Authorization comes from it
+    body: Any = None #sent as json
+
+    @field_validator('path')
+    @classmethod
+    def check_path(cls, path: str) -> str:
+        if not path.startswith('/') or path.startswith('//'):
+            raise ValueError('path has to start with /')
+        if urllib.parse.urlsplit(path).path.rstrip('/') == BATCH_PATH:
+            raise ValueError('batches can not be nested')
+        return path
+
+
+class BatchRequest(BaseModel):
+    requests: list[BatchItem] = Field(min_length=1)
+
+
+class BatchItemResult(BaseModel):
+    status: int
+    headers: dict[str, str]
+    body: Any = None #json value for json responses, text otherwise
+
+
+class BatchResponse(BaseModel):
+    responses: list[BatchItemResult]
+
+
+class ResponseTooLarge(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status: int = status
+
+
+class ByteBudget:
+    '''
+    Bytes of sub-response bodies one batch may still hold in memory
+    '''
+
+    def __init__(self, size: int) -> None:
+        self.left: int = size
+
+    def take(self, size: int) -> bool:
+        if size > self.left:
+            return False
+        self.left -= size
+        return True
+
+    def give_back(self, size: int) -> None:
+        self.left += size
+
+
+class BatchDispatcher:
+    '''
+    Runs sub-requests of a batch through the same handler as single requests
+    (policy check, rate limits, proxying), at most parallelism of them at once.
+    Sub-response bodies are buffered up to max_item_bytes each and max_bytes for the whole batch,
+    larger ones are replaced with 502 (item) or 413 (batch) results
+    '''
+
+    def __init__(
+        self, handler: Callable[[Request], Awaitable[Response]], parallelism: int, max_requests: int,
+        max_item_bytes: int, max_bytes: int,
+    ) -> None:
+        self.handler: Callable[[Request], Awaitable[Response]] = handler
+        self.parallelism: int = parallelism
+        self.max_requests: int = max_requests
+        self.max_item_bytes: int = max_item_bytes
+        self.max_bytes: int = max_bytes
+        self.batches: int = 0
+        self.sub_requests: int = 0
+        self.too_large: int = 0
+
+    async def run(self, request: Request, batch: BatchRequest) -> list[BatchItemResult]:
+        self.batches += 1
+        self.sub_requests += len(batch.requests)
+        semaphore = asyncio.Semaphore(self.parallelism)
+        budget = ByteBudget(self.max_bytes)
+        inherited = [(k, v) for k, v in request.headers.raw if k not in BODY_HEADERS]
+
+        async def dispatch(item: BatchItem) -> BatchItemResult:
+            async with semaphore:
+                try:
+                    response = await self.handler(self.__sub_request(request, inherited, item))
+                    return await self.__result(response, budget)
+                except ResponseTooLarge as E:
+                    self.too_large += 1
+                    logger.warning(f"Batch request {item.method} {item.path} dropped: {E}")
+                    return BatchItemResult(status=E.status, headers={}, body={'message': str(E)})
+                except Exception as E:
+                    logger.error(f"Error occured in batch request {item.method} {item.path}: {E!r}")
+                    return BatchItemResult(status=500, headers={}, body={'message': 'Internal server error'})
+
+        return list(await asyncio.gather(*(dispatch(item) for item in batch.requests)))
+
+    @staticmethod
+    def __sub_request(request: Request, inherited: list[tuple[bytes, bytes]], item: BatchItem) -> Request:
+        path, _, query = item.path.partition('?')
+        body = b'' if item.body is None else json.dumps(item.body).encode()
+
+        headers = {k.lower().encode('latin-1'): v.encode('latin-1') for k, v in item.headers.items()}
+        raw_headers = [(k, v) for k, v in inherited if k not in headers] + list(headers.items())
+        raw_headers = [(k, v) for k, v in raw_headers if k != b'accept-encoding'] + SUB_REQUEST_HEADERS
+        if item.body is not None:
+            raw_headers = [(k, v) for k, v in raw_headers if k not in BODY_HEADERS]
+            raw_headers += [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+
+        scope = {
+            'type': 'http',
+            'asgi': request.scope.get('asgi', {'version': '3.0'}),
+            'http_version': request.scope.get('http_version', '1.1'),
+            'method': item.method,
+            'scheme': request.url.scheme,
+            'server': request.scope.get('server'),
+            'client': request.scope.get('client'),
+            'root_path': '',
+            'path': urllib.parse.unquote(path),
+            'raw_path': path.encode(),
+            # as matched by catch all route, enforcer reads resource from it
+            'path_params': {'path_name': urllib.parse.unquote(path)[1:]},
+            'query_string': query.encode(),
+            'headers': raw_headers,
+            'state': {},
+        }
+        sent = False
+
+        async def receive() -> dict:
+            nonlocal sent
+            if sent:
+                return {'type': 'http.disconnect'}
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        return Request(scope, receive)
+
+    async def __result(self, response: Response, budget: ByteBudget) -> BatchItemResult:
+        body = await self.__read_body(response, budget)
+
+        headers = {}
+        for k, v in response.raw_headers:
+            name = k.decode('latin-1').lower()
+            if name not in NOT_RETURNED_HEADERS:
+                headers[name] = v.decode('latin-1')
+        return BatchItemResult(status=response.status_code, headers=headers, body=decode_body(body, headers))
+
+    async def __read_body(self, response: Response, budget: ByteBudget) -> bytes:
+        '''
+        Whole body of sub-response, ResponseTooLarge as soon as it is over item or batch limit
+        '''
+        if not isinstance(response, StreamingResponse):
+            self.__reserve(len(response.body), len(response.body), budget)
+            return response.body
+
+        chunks, size = [], 0
+        try:
+            async for chunk in response.body_iterator:
+                chunk = chunk if isinstance(chunk, bytes) else chunk.encode()
+                try:
+                    self.__reserve(size + len(chunk), len(chunk), budget)
+                except ResponseTooLarge:
+                    budget.give_back(size)
+                    raise
+                size += len(chunk)
+                chunks.append(chunk)
+        finally:
+            # body iterator closes upstream response once exhausted, or here when cut short
+            await response.body_iterator.aclose()
+        return b''.join(chunks)
+
+    def __reserve(self, total: int, size: int, budget: ByteBudget) -> None:
+        if total > self.max_item_bytes:
+            raise ResponseTooLarge(502, f'Response is larger than {self.max_item_bytes} bytes')
+        if not budget.take(size):
+            raise ResponseTooLarge(413, f'Batch responses are larger than {self.max_bytes} bytes')
+
+    def stats(self) -> dict:
+        return {
+            'parallelism': self.parallelism,
+            'max_requests': self.max_requests,
+            'max_item_bytes': self.max_item_bytes,
+            'max_bytes': self.max_bytes,
+            'batches': self.batches,
+            'sub_requests': self.sub_requests,
+            'too_large': self.too_large,
+        }
+
+
+def decode_body(body: bytes, headers: dict[str, str]) -> Any:
+    if not body:
+        return None
+    text = body.decode('utf-8', errors='replace')
+    if 'json' in headers.get('content-type', ''):
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+    return text
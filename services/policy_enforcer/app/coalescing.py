@@ -0,0 +1,85 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, NamedTuple
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from .metrics import COALESCED
+
+# request headers that can change upstream response besides subject, path and query
+KEY_HEADERS = ('accept', 'accept-encoding', 'if-none-match', 'if-modified-since', 'range', 'cache-control')
+
+
+class SharedResponse(NamedTuple):
+    status_code: int
+    headers: list[tuple[bytes, bytes]]
+    body: bytes
+
+    def response(self) -> Response:
+        response = Response(content=self.body, status_code=self.status_code)
+        response.raw_headers = list(self.headers)
+        return response
+
+
+class Coalescer:
+    '''
+    Single flight for identical concurrent safe requests: the first one goes upstream,
+    the ones arriving while it is in flight wait and get a copy of its response.
+    Responses that were streamed instead of buffered can not be replayed,
+    waiters of such requests go upstream on their own.
+    '''
+
+    def __init__(self, max_body_size: int) -> None:
+        self.max_body_size: int = max_body_size
+        self.leaders: int = 0
+        self.collapsed: int = 0
+        self.not_shared: int = 0
+        self.__in_flight: dict[Hashable, asyncio.Future] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_body_size > 0
+
+    @staticmethod
+    def make_key(subject: str, service: str, request: Request) -> tuple:
+        return (subject, service, request.method, request.url.path, request.url.query) + tuple(
+            request.headers.get(h, '') for h in KEY_HEADERS
+        )
+
+    async def run(self, key: tuple, fetch: Callable[[], Awaitable[Response]], labels: tuple[str, str]) -> Response:
+        leader = self.__in_flight.get(key)
+        if leader is not None:
+            # shielded, so a waiter going away does not cancel the shared call
+            shared = await asyncio.shield(leader)
+            if shared is not None:
+                self.collapsed += 1
+                COALESCED.inc(*labels)
+                return shared.response()
+            self.not_shared += 1
+            return await fetch()
+
+        future = asyncio.get_running_loop().create_future()
+        self.__in_flight[key] = future
+        self.leaders += 1
+        shared = None
+        try:
+            response = await fetch()
+            shared = self.__share(response)
+            return response
+        finally:
+            del self.__in_flight[key]
+            future.set_result(shared)
+
+    @staticmethod
+    def __share(response: Response) -> SharedResponse | None:
+        if isinstance(response, StreamingResponse):
+            return None
+        return SharedResponse(response.status_code, list(response.raw_headers), response.body)
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self.__in_flight),
+            'leaders': self.leaders,
+            'collapsed': self.collapsed,
+            'not_shared': self.not_shared,
+        }
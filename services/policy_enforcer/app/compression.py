@@ -0,0 +1,188 @@
+import zlib
+
+try:
+    import brotli
+except ImportError: #gzip only without brotli package
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/problem+json', 'application/javascript',
+    'application/xml', 'application/x-ndjson', 'image/svg+xml',
+)
+NOT_COMPRESSED_STATUSES = {204, 206, 304}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4 #higher qualities cost more cpu than the bytes they save are worth on the fly
+
+
+def parse_accept_encoding(value: str) -> dict[str, float]:
+    codings = {}
+    for part in value.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, arg = param.strip().partition('=')
+            if name.lower() == 'q':
+                try:
+                    q = float(arg)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def choose_encoding(accept_encoding: str | None) -> str | None:
+    '''
+    Best content coding the gateway can produce for the client, br is preferred on equal weight
+    '''
+    if not accept_encoding:
+        return None
+    codings = parse_accept_encoding(accept_encoding)
+    supported = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best, best_q = None, 0.0
+    for coding in supported:
+        q = codings.get(coding, codings.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def weak_etag(etag: bytes) -> bytes:
+    return etag if etag.startswith(b'W/') else b'W/' + etag
+
+
+def matching_etag(if_none_match: str | None, etag: str) -> str | None:
+    '''
+    Tag of If-None-Match equal to etag by weak comparison (as compressed responses carry weakened etags),
+    returned as the client sent it to be echoed in 304, None when nothing matches
+    '''
+    if not if_none_match:
+        return None
+    opaque = etag.removeprefix('W/')
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return etag
+        if tag.removeprefix('W/') == opaque:
+            return tag
+    return None
+
+
+def compressible(content_type: str) -> bool:
+    content_type = content_type.lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) or '+json' in content_type or '+xml' in content_type
+
+
+class StreamCompressor:
+    '''
+    Compresses body chunk by chunk, every chunk is flushed so streamed responses keep flowing
+    '''
+
+    def __init__(self, encoding: str) -> None:
+        if encoding == 'br':
+            self.__brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.__gzip = None
+        else:
+            self.__brotli = None
+            self.__gzip = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, chunk: bytes, last: bool) -> bytes:
+        if self.__brotli is not None:
+            data = self.__brotli.process(chunk) if chunk else b''
+            return data + (self.__brotli.finish() if last else self.__brotli.flush())
+        data = self.__gzip.compress(chunk)
+        return data + self.__gzip.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    '''
+    Compresses responses for clients accepting gzip or br.
+
+    Bodies upstream already encoded are passed through untouched, as are small
+    responses with known length, non textual types and Cache-Control: no-transform.
+    Streamed responses are compressed as they flow. Compressed responses get weak ETag,
+    a strong one names exact bytes and these differ from the uncompressed ones.
+    '''
+
+    def __init__(self, app, min_size: int) -> None:
+        self.app = app
+        self.min_size: int = min_size
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http' or self.min_size <= 0 or scope['method'] == 'HEAD':
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = None
+        for name, value in scope['headers']:
+            if name == b'accept-encoding':
+                accept_encoding = value.decode('latin-1')
+        encoding = choose_encoding(accept_encoding)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+
+        async def send_compressed(message) -> None:
+            nonlocal start, compressor
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if message['type'] != 'http.response.body':
+                await send(message)
+                return
+
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if start is not None:
+                compressor = self.__compressor(start, encoding, len(body), more_body)
+                if compressor is not None:
+                    start = self.__compressed_start(start, encoding)
+                await send(start)
+                start = None
+
+            if compressor is None:
+                await send(message)
+                return
+            await send({
+                'type': 'http.response.body',
+                'body': compressor.compress(body, last=not more_body),
+                'more_body': more_body,
+            })
+
+        await self.app(scope, receive, send_compressed)
+
+    def __compressor(self, start: dict, encoding: str, first_chunk: int, more_body: bool) -> StreamCompressor | None:
+        if start['status'] in NOT_COMPRESSED_STATUSES:
+            return None
+        headers = {k.lower(): v for k, v in start.get('headers', [])}
+        if b'content-encoding' in headers:
+            return None
+        if b'no-transform' in headers.get(b'cache-control', b'').lower():
+            return None
+        if not compressible(headers.get(b'content-type', b'').decode('latin-1')):
+            return None
+
+        content_length = headers.get(b'content-length')
+        size = int(content_length) if content_length is not None and content_length.isdigit() else None
+        if size is None and not more_body:
+            size = first_chunk
+        if size is not None and size < self.min_size:
+            return None
+        return StreamCompressor(encoding)
+
+    @staticmethod
+    def __compressed_start(start: dict, encoding: str) -> dict:
+        headers = [
+            (k, weak_etag(v) if k.lower() == b'etag' else v)
+            for k, v in start.get('headers', []) if k.lower() != b'content-length'
+        ]
+        vary = [v for k, v in headers if k.lower() == b'vary']
+        if not any(b'accept-encoding' in v.lower() or v.strip() == b'*' for v in vary):
+            headers.append((b'vary', b'Accept-Encoding'))
+        headers.append((b'content-encoding', encoding.encode()))
+        return {**start, 'headers': headers}
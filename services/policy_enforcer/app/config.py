@@ -1,4 +1,4 @@
-from typing import Tuple, Type
+from typing import Literal, Tuple, Type
 
 from pydantic_settings import BaseSettings, PydanticBaseSettingsSource
 from pydantic import Field, FilePath, SecretStr
@@ -13,6 +13,121 @@ class Config(BaseSettings):
         alias='POLICIES_CONFIG_PATH'
     )
 
+    decision_cache_size: int = Field(
+        default=10000,
+        alias='DECISION_CACHE_SIZE'
+    )
+
+    decision_cache_ttl: float = Field(
+        default=60.0,
+        alias='DECISION_CACHE_TTL'
+    )
+
+    policy_engine: Literal['compiled', 'casbin'] = Field(
+        default='compiled',
+        alias='POLICY_ENGINE'
+    )
+
+    token_cache_size: int = Field(
+        default=10000,
+        alias='TOKEN_CACHE_SIZE'
+    )
+
+    max_request_body_size: int = Field(
+        default=10 * 1024 * 1024,
+        alias='MAX_REQUEST_BODY_SIZE'
+    )
+
+    request_body_buffer_size: int = Field(
+        default=64 * 1024,
+        alias='REQUEST_BODY_BUFFER_SIZE'
+    )
+
+    rate_limit_buckets: int = Field(
+        default=100000,
+        alias='RATE_LIMIT_BUCKETS'
+    )
+
+    response_cache_max_bytes: int = Field(
+        default=0,
+        alias='RESPONSE_CACHE_MAX_BYTES'
+    )
+
+    response_cache_max_entry_bytes: int = Field(
+        default=256 * 1024,
+        alias='RESPONSE_CACHE_MAX_ENTRY_BYTES'
+    )
+
+    coalesce_max_body_size: int = Field(
+        default=1024 * 1024,
+        alias='COALESCE_MAX_BODY_SIZE'
+    )
+
+    compression_min_size: int = Field(
+        default=1024,
+        alias='COMPRESSION_MIN_SIZE'
+    )
+
+    batch_max_requests: int = Field(
+        default=50,
+        alias='BATCH_MAX_REQUESTS'
+    )
+
+    batch_parallelism: int = Field(
+        default=8,
+        alias='BATCH_PARALLELISM'
+    )
+
+    batch_max_item_bytes: int = Field(
+        default=1024 * 1024,
+        alias='BATCH_MAX_ITEM_BYTES'
+    )
+
+    batch_max_bytes: int = Field(
+        default=10 * 1024 * 1024,
+        alias='BATCH_MAX_BYTES'
+    )
+
+    openapi_refresh_interval: float = Field(
+        default=60.0,
+        alias='OPENAPI_REFRESH_INTERVAL'
+    )
+
+    openapi_fetch_timeout: float = Field(
+        default=5.0,
+        alias='OPENAPI_FETCH_TIMEOUT'
+    )
+
+    policies_reload_interval: float = Field(
+        default=5.0,
+        alias='POLICIES_RELOAD_INTERVAL'
+    )
+
+    upstream_drain_timeout: float = Field(
+        default=60.0,
+        alias='UPSTREAM_DRAIN_TIMEOUT'
+    )
+
+    log_level: str = Field(
+        default='INFO',
+        alias='LOG_LEVEL'
+    )
+
+    log_sample_rate: float = Field(
+        default=1.0,
+        alias='LOG_SAMPLE_RATE'
+    )
+
+    workers: int = Field(
+        default=0,
+        alias='WORKERS'
+    )
+
+    admin_token: SecretStr | None = Field(
+        default=None,
+        alias='GATEWAY_ADMIN_TOKEN'
+    )
+
     @classmethod
     def settings_customise_sources(
         cls,
@@ -0,0 +1,217 @@
+import ast
+import logging
+import re
+from typing import Any, Callable
+
+import casbin
+from casbin import util
+
+logger = logging.getLogger("policy-enforcement-service")
+
+# matcher terms that are evaluated natively, anything else keeps casbin
+MATCHER_TERMS = {
+    'eval(p_sub_rule)': 'rule',
+    'keyMatch(r_obj, p_obj)': 'obj',
+    'regexMatch(r_act, p_act)': 'act',
+}
+SUPPORTED_EFFECT = 'some(where (p_eft == allow))'
+
+# same limit and forbidden attributes as simpleeval used by casbin
+MAX_STRING_LENGTH = 100000
+DISALLOWED_ATTRIBUTES = ('_', 'func_')
+
+ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot,
+    ast.IfExp, ast.Tuple, ast.List, ast.Set, ast.Constant, ast.Load,
+)
+# request values rules may read besides claims of r.sub
+REQUEST_NAMES = {'r_obj': 'obj', 'r_act': 'act'}
+
+
+class UnsupportedRule(ValueError):
+    pass
+
+
+class RuleCompiler(ast.NodeTransformer):
+    '''
+    Validates rule syntax tree and turns r_sub.<claim> into sub['<claim>'], collecting claims it reads
+    '''
+
+    def __init__(self) -> None:
+        self.claims: set[str] = set()
+
+    def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        if not (isinstance(node.value, ast.Name) and node.value.id == 'r_sub'):
+            raise UnsupportedRule(f'attribute {ast.unparse(node)}')
+        if node.attr.startswith(DISALLOWED_ATTRIBUTES) or hasattr(dict, node.attr):
+            # casbin reads dict attributes before claims, leave such rules to it
+            raise UnsupportedRule(f'claim {node.attr}')
+        self.claims.add(node.attr)
+        return ast.Subscript(value=ast.Name(id='sub', ctx=ast.Load()), slice=ast.Constant(node.attr), ctx=ast.Load())
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        if node.id not in REQUEST_NAMES:
+            raise UnsupportedRule(f'name {node.id}')
+        return ast.Name(id=REQUEST_NAMES[node.id], ctx=ast.Load())
+
+    def visit_Constant(self, node: ast.Constant) -> ast.AST:
+        if hasattr(node.value, '__len__') and len(node.value) > MAX_STRING_LENGTH:
+            raise UnsupportedRule('constant too long')
+        return node
+
+    def generic_visit(self, node: ast.AST) -> ast.AST:
+        if not isinstance(node, ALLOWED_NODES):
+            raise UnsupportedRule(f'{type(node).__name__} in rule')
+        return super().generic_visit(node)
+
+
+def casbin_expression(rule: str) -> str:
+    '''
+    Rule text after the same rewriting casbin does before evaluating it
+    '''
+    expression = util.escape_assertion(rule)
+    return expression.replace("&&", "and").replace("||", "or").replace("!", "not")
+
+
+def parse_rule(rule: str) -> tuple[ast.expr, set[str]]:
+    '''
+    Validated rule expression reading claims from sub, and the claims it reads
+    '''
+    try:
+        tree = ast.parse(casbin_expression(rule).strip(), mode='eval')
+    except SyntaxError as E:
+        raise UnsupportedRule(f'syntax error: {E}')
+
+    compiler = RuleCompiler()
+    return compiler.visit(tree).body, compiler.claims
+
+
+def rule_claims(rule: str) -> set[str]:
+    '''
+    Claims the rule reads as r.sub.<claim>, UnsupportedRule when it reads r.sub any other way
+    '''
+    return parse_rule(rule)[1]
+
+
+def compile_rule(rule: str) -> Callable[[dict, str, str], Any]:
+    '''
+    Python function (sub, obj, act) computing the same value casbin's eval() of the rule does
+    '''
+    body, _ = parse_rule(rule)
+    args = ast.arguments(
+        posonlyargs=[], args=[ast.arg('sub'), ast.arg('obj'), ast.arg('act')],
+        kwonlyargs=[], kw_defaults=[], defaults=[],
+    )
+    function = ast.fix_missing_locations(ast.Expression(body=ast.Lambda(args=args, body=body)))
+    return eval(compile(function, f'<rule {rule}>', 'eval'), {'__builtins__': {}})
+
+
+class PolicyPredicate:
+    __slots__ = ('terms',)
+
+    def __init__(self, terms: list[str], rule: str, obj: str, act: str) -> None:
+        try:
+            act_pattern = re.compile(act)
+        except re.error as E:
+            raise UnsupportedRule(f'methods pattern {act}: {E}')
+        checks = {
+            'rule': compile_rule(rule),
+            'obj': lambda sub, o, a: util.key_match(o, obj),
+            'act': lambda sub, o, a: act_pattern.match(a) is not None,
+        }
+        self.terms: tuple = tuple(checks[t] for t in terms)
+
+
+class CompiledEnforcer:
+    '''
+    Evaluates standard policies model with policy rules compiled to Python functions.
+
+    Policies are checked in casbin order with the same short circuiting of matcher terms,
+    so results are the same. Whenever casbin would raise or return something
+    other than allow/deny (missing claim, non boolean rule result), the request
+    is handed to casbin enforcer, as is everything when model or some rule is not supported.
+    '''
+
+    def __init__(self, enforcer: casbin.Enforcer) -> None:
+        self.__enforcer: casbin.Enforcer = enforcer
+        self.__model = None
+        self.__policies: list[PolicyPredicate] = None
+        self.fallbacks: int = 0
+
+    @property
+    def compiled(self) -> bool:
+        return self.__policies is not None
+
+    def update(self) -> None:
+        '''
+        Recompile policies from casbin model, called when policies change
+        '''
+        self.__model = self.__enforcer.model
+        try:
+            self.__policies = self.__compile()
+        except UnsupportedRule as E:
+            logger.warning(f"Policies are not compiled, using casbin: {E}")
+            self.__policies = None
+
+    def enforce(self, sub: dict, obj: str, act: str) -> bool:
+        if self.__enforcer.model is not self.__model:
+            self.update()
+        if self.__policies is None:
+            return self.__enforcer.enforce(sub, obj, act)
+
+        try:
+            for policy in self.__policies:
+                result = True
+                for term in policy.terms:
+                    result = term(sub, obj, act)
+                    if not result:
+                        break
+
+                if isinstance(result, bool):
+                    if result:
+                        return True
+                elif isinstance(result, float):
+                    if result != 0:
+                        return True
+                else:
+                    raise UnsupportedRule('non boolean matcher result')
+            return False
+        except Exception:
+            # let casbin produce its own result or error
+            self.fallbacks += 1
+            return self.__enforcer.enforce(sub, obj, act)
+
+    def __compile(self) -> list[PolicyPredicate]:
+        model = self.__model
+        if 'g' in model.keys():
+            raise UnsupportedRule('role definitions')
+        if model['e']['e'].value != SUPPORTED_EFFECT:
+            raise UnsupportedRule(f"effect {model['e']['e'].value}")
+        if model['r']['r'].tokens != ['r_sub', 'r_obj', 'r_act']:
+            raise UnsupportedRule(f"request definition {model['r']['r'].tokens}")
+        p_tokens = model['p']['p'].tokens
+        if sorted(p_tokens) != ['p_act', 'p_obj', 'p_sub_rule']:
+            raise UnsupportedRule(f"policy definition {p_tokens}")
+
+        matcher = model['m']['m'].value
+        terms = [MATCHER_TERMS.get(term.strip()) for term in matcher.split('&&')]
+        if None in terms or len(set(terms)) != len(terms):
+            raise UnsupportedRule(f'matcher {matcher}')
+
+        policies = self.__enforcer.get_policy()
+        if not policies:
+            # casbin raises for eval() without policies
+            raise UnsupportedRule('no policies')
+
+        compiled = []
+        for p in policies:
+            values = dict(zip(p_tokens, p))
+            compiled.append(PolicyPredicate(terms, values['p_sub_rule'], values['p_obj'], values['p_act']))
+        return compiled
+
+    def stats(self) -> dict:
+        return {
+            'engine': 'compiled' if self.compiled else 'casbin (unsupported policies)',
+            'fallbacks': self.fallbacks,
+        }
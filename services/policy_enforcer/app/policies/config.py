@@ -1,18 +1,93 @@
 import urllib.parse
-from pydantic import BaseModel, HttpUrl
+from typing import Literal
+
+from pydantic import BaseModel, Field, HttpUrl, model_validator
+
+
+class PoolSettings(BaseModel):
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    write_timeout: float = 30.0
+    pool_timeout: float = 5.0
+
+
+class HealthCheck(BaseModel):
+    enabled: bool = True
+    path: str = 'openapi.json'
+    interval: float = 10.0
+    timeout: float = 2.0
+    unhealthy_threshold: int = 2
+    healthy_threshold: int = 1
+
+
+class CircuitBreakerSettings(BaseModel):
+    enabled: bool = True
+    failure_threshold: int = 5 #failed calls in a row to open circuit
+    failure_statuses: list[int] = [502, 503, 504] #connection errors and timeouts always count
+    slow_call_threshold: float = None #seconds to response headers, slower calls count as failed
+    open_timeout: float = 10.0 #seconds before probe requests are let through
+    half_open_requests: int = 1 #probe requests that have to pass to close circuit
+
+
+class RetrySettings(BaseModel):
+    attempts: int = 0 #extra attempts for GET and HEAD requests
+    backoff: float = 0.05 #seconds, doubled every attempt, randomized with full jitter
+    max_backoff: float = 1.0
+    on_statuses: list[int] = [502, 503, 504]
+
+
+class HedgeSettings(BaseModel):
+    enabled: bool = False
+    percentile: float = 95.0 #GET and HEAD requests slower than this get second request to other instance
+    min_delay: float = 0.01 #seconds
+    min_samples: int = 20
+
+
+class RateLimit(BaseModel):
+    rate: float = Field(gt=0) #tokens per second
+    burst: int = Field(default=1, ge=1)
 
 
 class Service(BaseModel):
     name: str
-    entrypoint: HttpUrl
+    entrypoint: HttpUrl = None
+    entrypoints: list[HttpUrl] = []
+    balancer: Literal['round_robin', 'least_outstanding', 'p2c'] = 'round_robin'
+    health_check: HealthCheck = HealthCheck()
     inject_token_in_swagger: bool = False
+    pool: PoolSettings = PoolSettings()
+    max_concurrency: int = 0 #requests in flight to all instances, 0 for no limit
+    circuit_breaker: CircuitBreakerSettings = CircuitBreakerSettings()
+    retry: RetrySettings = RetrySettings()
+    hedge: HedgeSettings = HedgeSettings()
+    http2: bool = False #h2c with prior knowledge, upstream has to serve HTTP/2 over plain tcp
+
+    @model_validator(mode='after')
+    def check_entrypoints(self) -> 'Service':
+        if self.entrypoint is None:
+            if not self.entrypoints:
+                raise ValueError(f'service {self.name} needs entrypoint or entrypoints')
+            self.entrypoint = self.entrypoints[0]
+        return self
+
+    @property
+    def endpoints(self) -> list[str]:
+        '''
+        Urls of all service instances, primary entrypoint first
+        '''
+        urls = [self.entrypoint.unicode_string()] + [e.unicode_string() for e in self.entrypoints]
+        return list(dict.fromkeys(urls))
 
     @property
     def openapi_scheme(self) -> str:
         return urllib.parse.urljoin(
             self.entrypoint.unicode_string(), 'openapi.json'
-        ) 
-    
+        )
+
     def __repr__(self) -> str:
         return f"Service({self.name}, {self.entrypoint})"
 
@@ -22,6 +97,15 @@ class Policy(BaseModel):
     resource: str
     methods: str
     white_list: bool = False
+    cache_ttl: float = 0.0
+    rate_limit: RateLimit = None #per subject, per client ip on white list
+
+    @property
+    def scope(self) -> tuple:
+        '''
+        Identity of policy that survives policies reload
+        '''
+        return (self.service, self.resource, self.methods, self.white_list)
 
     @property
     def method_list(self) -> list[str]:
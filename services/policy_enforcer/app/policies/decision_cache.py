@@ -0,0 +1,107 @@
+import re
+
+import casbin
+from casbin import util
+
+from .cache import LRUCache
+from .compiled import CompiledEnforcer, UnsupportedRule, rule_claims
+from .route_index import KeyMatchIndex
+
+RULE_OBJ = re.compile(r'\br[._]obj\b')
+STANDARD_OBJ_MATCH = 'keyMatch(r_obj, p_obj)'
+# key of a claim the token does not have, casbin raises for it unlike for None
+MISSING = object()
+
+
+class DecisionCache:
+    '''
+    LRU cache of casbin allow/deny decisions.
+
+    Decisions are keyed on the token claims policy rules read (whole token
+    unless every rule reads it only as r.sub.<claim>), the policy
+    objects matching the resource with keyMatch (the resource itself when
+    a rule reads r.obj) and the request method.
+    It is registered as casbin watcher, so policies added or removed through
+    the enforcer drop the cache, and reloading policies is detected by model swap.
+    Cache misses are decided by `engine` (casbin enforcer itself unless given).
+    '''
+
+    def __init__(self, enforcer: casbin.Enforcer, maxsize: int, ttl: float, engine: CompiledEnforcer = None) -> None:
+        self.__enforcer: casbin.Enforcer = enforcer
+        self.__engine: CompiledEnforcer | casbin.Enforcer = engine or enforcer
+        self.__cache: LRUCache = LRUCache(maxsize, ttl)
+        self.update()
+        enforcer.set_watcher(self)
+
+    def enforce(self, token_data: dict, resource: str, method: str) -> bool:
+        if self.__enforcer.model is not self.__model:
+            self.update()
+
+        key = self.__make_key(token_data, resource, method)
+        if key is None:
+            return self.__engine.enforce(token_data, resource, method)
+
+        decision = self.__cache.get(key)
+        if decision is None:
+            decision = self.__engine.enforce(token_data, resource, method)
+            self.__cache.set(key, decision)
+        return decision
+
+    def update(self) -> None:
+        '''
+        Drop cached decisions and rebuild the key layout from current policies
+        '''
+        self.__cache.clear()
+        self.__model = self.__enforcer.model
+        if self.__engine is not self.__enforcer:
+            self.__engine.update()
+
+        matcher: str = self.__model['m']['m'].value
+        p_tokens: list[str] = self.__model['p']['p'].tokens
+        policies: list[list[str]] = self.__enforcer.get_policy()
+
+        rules = [p[p_tokens.index(column)] for column in util.get_eval_value(matcher) for p in policies]
+        self.__claims: tuple[str, ...] = None if 'r_sub' in matcher else self.__rule_claims(rules)
+
+        # rules reading r.obj tell apart resources matching the same policies, they are keyed as they are.
+        # r.act needs nothing, method is always part of the key
+        if matcher.count('r_obj') == 1 and STANDARD_OBJ_MATCH in matcher and not any(RULE_OBJ.search(rule) for rule in rules):
+            self.__key_index: KeyMatchIndex = KeyMatchIndex([p[p_tokens.index('p_obj')] for p in policies])
+        else:
+            self.__key_index = None
+
+    @staticmethod
+    def __rule_claims(rules: list[str]) -> tuple[str, ...] | None:
+        '''
+        Claims read by rules taken from their syntax trees, None (whole subject is
+        the key) when some rule reads r.sub other than as a plain r.sub.<claim>
+        '''
+        claims = set()
+        for rule in rules:
+            try:
+                claims.update(rule_claims(rule))
+            except UnsupportedRule:
+                return None
+        return tuple(sorted(claims))
+
+    def set_update_callback(self, func: callable) -> None:
+        # part of casbin watcher interface, policies are never loaded from outside
+        pass
+
+    def __make_key(self, token_data: dict, resource: str, method: str) -> tuple:
+        # 1, 1.0 and True are equal keys, but rules can tell them apart, so types are keyed as well
+        if self.__claims is None:
+            claims = tuple(sorted((k, type(v), v) for k, v in token_data.items()))
+        else:
+            claims = tuple((type(v), v) for v in (token_data.get(c, MISSING) for c in self.__claims))
+
+        objects = resource if self.__key_index is None else self.__key_index.match(resource)
+        key = (claims, objects, method)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def stats(self) -> dict:
+        return self.__cache.stats()
@@ -1,6 +1,9 @@
-import re
-import tempfile
+import asyncio
 import logging
+import hashlib
+import os
+import time
+from typing import Callable
 
 import casbin
 import yaml
@@ -12,7 +15,13 @@ from pydantic.dataclasses import dataclass
 
 
 
+from ..metrics import DECISIONS, STAGE_SECONDS, UNMATCHED, Timer
+from .cache import LRUCache
 from .config import PoliciesConfig, Policy, Service
+from .compiled import CompiledEnforcer
+from .decision_cache import DecisionCache
+from .rate_limit import RateLimiter
+from .route_index import RouteIndex
 
 logger = logging.getLogger("policy-enforcement-service")
 
@@ -20,26 +29,134 @@ logger = logging.getLogger("policy-enforcement-service")
 class EnforceResult:
     access_allowed: bool = False
     redirect_service: str = None
+    service_name: str = None
+    subject: str | None = None
+    cache_ttl: float = 0.0
+    retry_after: float | None = None
+    route: str | None = None #resource pattern of matched policy
+
+
+class PolicySnapshot:
+    '''
+    Everything built from one version of policies.yaml.
+    Snapshots are never modified after creation, reload builds a new one.
+    '''
+
+    def __init__(self, config: PoliciesConfig, decision_cache_size: int, decision_cache_ttl: float,
+                 engine: str = 'compiled') -> None:
+        self.config: PoliciesConfig = config
+        self.enforcer: casbin.Enforcer = self.__create_enforcer()
+        self.compiled: CompiledEnforcer = CompiledEnforcer(self.enforcer) if engine == 'compiled' else None
+        self.decision_cache: DecisionCache = DecisionCache(
+            self.enforcer, decision_cache_size, decision_cache_ttl, self.compiled
+        )
+        self.route_index: RouteIndex = RouteIndex(self.config.policies)
+        self.service_map: dict[str, Service] = {s.name: s for s in self.config.services}
+
+    def __create_enforcer(self) -> casbin.Enforcer:
+        model = casbin.Enforcer.new_model(text=self.config.model)
+        enforcer = casbin.Enforcer(model)
+        enforcer.add_policies(
+            [[str(p.rule), p.resource, p.methods] for p in self.config.policies if not p.white_list]
+        )
+        return enforcer
 
 
 class RequestEnforcer:
-    def __init__(self, config_path: str, jwt_secret: str) -> None:
+    def __init__(self, config_path: str, jwt_secret: str,
+                 decision_cache_size: int = 10000, decision_cache_ttl: float = 60.0,
+                 token_cache_size: int = 10000, rate_limit_buckets: int = 100000,
+                 policy_engine: str = 'compiled') -> None:
+        self.config_path: str = config_path
         self.jwt_secret: str = jwt_secret
-        self.config: PoliciesConfig = self.__load_config(config_path=config_path)
-        self.enforcer: casbin.Enforcer = self.__create_enforcer()
+        self.decision_cache_size: int = decision_cache_size
+        self.decision_cache_ttl: float = decision_cache_ttl
+        self.policy_engine: str = policy_engine
+        self.token_cache: LRUCache = LRUCache(token_cache_size)
+        self.rate_limiter: RateLimiter = RateLimiter(rate_limit_buckets)
+        # picks service instance for redirect, primary entrypoint unless replaced by load balancer
+        self.endpoint_selector: Callable[[Service], str] = lambda s: s.entrypoint.unicode_string()
+        self.__config_mtime: float = None
+        self.snapshot: PolicySnapshot = self.__load_snapshot()
 
     async def enforce(self, request: Request) -> EnforceResult:
-        in_whitelist, service_name = self.__is_request_in_whilelist(request)
-        if in_whitelist:
-            service = self.__get_service_by_name(service_name)
-            return EnforceResult(True, service.entrypoint.unicode_string())
-        
-        access_allowed, service_name = await self.__check_by_policy(request)
-        if access_allowed:
-            service = self.__get_service_by_name(service_name)
-            return EnforceResult(True, service.entrypoint.unicode_string())
-        
-        return EnforceResult()
+        # requests finish on the snapshot they started with, even if reload happens meanwhile
+        snapshot = self.snapshot
+
+        resource = '/' + request.path_params['path_name']
+        started = time.perf_counter()
+        route = snapshot.route_index.match(resource, request.method)
+        policy = route.whitelist or route.enforcing
+        labels = (policy.service, policy.resource) if policy is not None else UNMATCHED
+        STAGE_SECONDS.observe(time.perf_counter() - started, 'whitelist_match', *labels)
+
+        if route.whitelist is not None:
+            client_ip = request.client.host if request.client else None
+            result = self.__limit(route.whitelist, client_ip) or self.__make_result(snapshot, route.whitelist)
+        elif route.enforcing is None:
+            result = EnforceResult()
+        else:
+            token_data = await self.__check_by_policy(snapshot, request, resource, labels)
+            if token_data is not None:
+                subject = token_data.get('sub')
+                result = self.__limit(route.enforcing, subject) or self.__make_result(snapshot, route.enforcing, subject)
+            else:
+                result = EnforceResult()
+
+        result.service_name = result.service_name or labels[0]
+        result.route = labels[1]
+        if result.retry_after is not None:
+            DECISIONS.inc(*labels, 'rate_limited')
+        else:
+            DECISIONS.inc(*labels, 'allow' if result.access_allowed else 'deny')
+        return result
+
+    async def reload(self) -> None:
+        '''
+        Build new snapshot from policies config and swap it in
+        '''
+        self.__swap(await asyncio.to_thread(self.__load_snapshot))
+
+    def reload_blocking(self) -> None:
+        '''
+        reload() without event loop, for app.serve master which forks workers from its snapshot
+        '''
+        self.__swap(self.__load_snapshot())
+
+    def __swap(self, snapshot: PolicySnapshot) -> None:
+        self.snapshot = snapshot
+        logger.info(f"Policies reloaded: {len(snapshot.config.policies)} policies, services: {self.services}")
+
+    def config_changed(self) -> bool:
+        try:
+            return os.stat(self.config_path).st_mtime != self.__config_mtime
+        except OSError:
+            return False
+
+    def __limit(self, policy: Policy, client: str) -> EnforceResult | None:
+        '''
+        Denied result if client ran out of requests allowed by policy
+        '''
+        if policy.rate_limit is None:
+            return None
+        retry_after = self.rate_limiter.take(policy.rate_limit, policy.scope, client)
+        if retry_after:
+            return EnforceResult(service_name=policy.service, retry_after=retry_after)
+        return None
+
+    def __make_result(self, snapshot: PolicySnapshot, policy: Policy, subject: str = None) -> EnforceResult:
+        service = snapshot.service_map.get(policy.service)
+        if service is None:
+            return EnforceResult()
+        return EnforceResult(True, self.endpoint_selector(service), service.name, subject, policy.cache_ttl)
+
+    def __load_snapshot(self) -> PolicySnapshot:
+        # remember version before parsing, so broken config is not retried until it changes again
+        self.__config_mtime = os.stat(self.config_path).st_mtime
+        return PolicySnapshot(
+            self.__load_config(self.config_path), self.decision_cache_size, self.decision_cache_ttl,
+            self.policy_engine
+        )
 
     def __load_config(self, config_path: str) -> PoliciesConfig:
         with open(config_path) as file:
@@ -47,68 +164,61 @@ class RequestEnforcer:
             logger.info(f"Config loaded: {json.dumps(data,indent=4)}")
             return PoliciesConfig(**data)
 
-    def __create_enforcer(self) -> casbin.Enforcer:
-        model_conf = self.__make_model_temp_file()
-        policy_conf = self.__make_policy_temp_file()
-        return casbin.Enforcer(model_conf, policy_conf)
-
-    def __make_model_temp_file(self) -> str:
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        with open(tmp.name, 'w') as f:
-            f.write(self.config.model)
-
-        return tmp.name
-
-    def __make_policy_temp_file(self) -> str:
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        with open(tmp.name, 'w') as f:
-            f.writelines(
-                list(f'p, {p.rule}, {p.resource}, {p.methods}\n' for p in self.config.policies if not p.white_list)
-            )
-        return tmp.name
-
-    def __is_request_in_whilelist(self, request: Request) -> tuple[bool, str]:
-        resource = '/' + request.path_params['path_name']
-        for p in self.whilelist_policies:
-            if re.match(p.resource, resource) is not None and request.method in p.method_list:
-                return True, p.service
-        return False, None   
-    
     async def __extract_token_data(self, request: Request) -> dict:
         try:
             if 'authorization' in request.headers:
                 token = request.headers['authorization'].split(' ')[1]
-                decoded = jwt.decode(token, self.jwt_secret, algorithms=["HS256"])
-                return decoded
+                return self.__decode_token(token)
         except Exception as E:
             logger.error(f"Error occured in extract token_data: {E}")
             return None
         return None
-    
-    async def __check_by_policy(self, request: Request) -> tuple[bool, str]:
-        token_data = await self.__extract_token_data(request)
+
+    def __decode_token(self, token: str) -> dict:
+        key = hashlib.sha256(token.encode()).digest()
+        decoded = self.token_cache.get(key)
+        if decoded is not None:
+            return decoded
+
+        decoded = jwt.decode(token, self.jwt_secret, algorithms=["HS256"])
+        if 'exp' in decoded:
+            # verified claims are valid until token expiry
+            self.token_cache.set(key, decoded, ttl=decoded['exp'] - time.time())
+        return decoded
+
+    async def __check_by_policy(self, snapshot: PolicySnapshot, request: Request, resource: str,
+                                labels: tuple[str, str]) -> dict | None:
+        '''
+        Token data of request if access is allowed
+        '''
+        with Timer(STAGE_SECONDS, 'jwt_decode', *labels):
+            token_data = await self.__extract_token_data(request)
 
         if token_data is None:
-            return False, None
+            return None
 
-        resource = '/' + request.path_params['path_name']
+        # claims stay out of logs, lazy formatting costs nothing while debug is off
+        logger.debug("Access check of subject %s: %s %s", token_data.get('sub'), request.method, resource)
+        with Timer(STAGE_SECONDS, 'casbin_enforce', *labels):
+            allowed = snapshot.decision_cache.enforce(token_data, resource, request.method)
+        return token_data if allowed else None
 
-        logger.info(f"Token data: {token_data}, resource: {resource}, method: {request.method}")
-        access_allowed  = self.enforcer.enforce(token_data, resource, request.method)
-        if access_allowed is False:
-            return False, None
-
-        for p in self.enforcing_policies:
-            if re.match(p.resource, resource) is not None and request.method in p.method_list:
-                return True, p.service
-        
-        return True, None
-
-    def __get_service_by_name(self, service_name: str) -> Service:
-        for s in self.config.services:
-            if s.name == service_name:
-                return s
-        return None
+    @property
+    def config(self) -> PoliciesConfig:
+        return self.snapshot.config
+
+    @property
+    def enforcer(self) -> casbin.Enforcer:
+        return self.snapshot.enforcer
+
+    @property
+    def decision_cache(self) -> DecisionCache:
+        return self.snapshot.decision_cache
+
+    @property
+    def engine_stats(self) -> dict:
+        compiled = self.snapshot.compiled
+        return compiled.stats() if compiled is not None else {'engine': 'casbin'}
 
     @property
     def service_schemes(self) -> list[str]:
@@ -122,11 +232,11 @@ class RequestEnforcer:
     @property
     def whilelist_resources(self) -> list[str]:
         return [p.resource for p in self.config.policies if p.white_list]
-    
+
     @property
     def whilelist_policies(self) -> list[Policy]:
         return [p for p in self.config.policies if p.white_list]
-    
+
     @property
     def enforcing_policies(self) -> list[Policy]:
-        return [p for p in self.config.policies if not p.white_list]
\ No newline at end of file
+        return [p for p in self.config.policies if not p.white_list]
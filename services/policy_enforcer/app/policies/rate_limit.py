@@ -0,0 +1,111 @@
+import time
+from typing import Hashable
+
+from ..shared_memory import SharedTable
+from .cache import LRUCache
+from .config import RateLimit
+
+# longest wait told to limited clients, in seconds
+MAX_RETRY_AFTER = 3600
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate: float = rate
+        self.burst: int = burst
+        self.tokens: float = float(burst)
+        self.updated_at: float = time.monotonic()
+
+    def take(self) -> float:
+        '''
+        Seconds until a token is available, 0 if one was taken
+        '''
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    '''
+    Token buckets per policy and client, idle clients are forgotten in LRU order.
+    Buckets are kept across policies reloads while limit of their policy stays the same.
+    '''
+
+    def __init__(self, max_buckets: int) -> None:
+        self.__buckets: LRUCache = LRUCache(max_buckets)
+        self.allowed: int = 0
+        self.limited: int = 0
+
+    def take(self, limit: RateLimit, scope: Hashable, client: str) -> float:
+        key = (scope, client)
+        bucket = self.__buckets.get(key)
+        if bucket is None or bucket.rate != limit.rate or bucket.burst != limit.burst:
+            bucket = TokenBucket(limit.rate, limit.burst)
+            self.__buckets.set(key, bucket)
+
+        retry_after = bucket.take()
+        if retry_after:
+            self.limited += 1
+        else:
+            self.allowed += 1
+        return retry_after
+
+    def stats(self) -> dict:
+        return {
+            'buckets': len(self.__buckets),
+            'maxsize': self.__buckets.maxsize,
+            'allowed': self.allowed,
+            'limited': self.limited,
+        }
+
+
+class SharedRateLimiter:
+    '''
+    RateLimiter with buckets in shared memory, so forked workers enforce one limit together.
+    When shared memory lock is not acquired in time, the worker limits with its own buckets.
+    '''
+
+    def __init__(self, max_buckets: int) -> None:
+        # tokens, updated_at, rate, burst
+        self.__table: SharedTable = SharedTable('rate_limit', max_buckets, fields=4, age_field=1)
+        self.__local: RateLimiter = RateLimiter(max_buckets)
+        self.allowed: int = 0
+        self.limited: int = 0
+
+    def take(self, limit: RateLimit, scope: Hashable, client: str) -> float:
+        key_hash = self.__table.key_hash((scope, client))
+        bucket = TokenBucket(limit.rate, limit.burst)
+        with self.__table.locked() as acquired:
+            if not acquired:
+                return self.__local.take(limit, scope, client)
+            index, values, evicted = self.__table.find(key_hash)
+            if values is not None and values[2] == limit.rate and values[3] == limit.burst:
+                bucket.tokens, bucket.updated_at = values[0], values[1]
+            retry_after = bucket.take()
+            self.__table.write(
+                index, key_hash, (bucket.tokens, bucket.updated_at, limit.rate, limit.burst),
+                new=values is None and evicted is None,
+            )
+
+        if retry_after:
+            self.limited += 1
+        else:
+            self.allowed += 1
+        return retry_after
+
+    def stats(self) -> dict:
+        return {
+            'buckets': self.__table.used,
+            'maxsize': self.__table.slots,
+            'allowed': self.allowed + self.__local.allowed, #of this worker
+            'limited': self.limited + self.__local.limited,
+            'lock_misses': self.__table.lock_misses,
+            'shared': True,
+        }
@@ -0,0 +1,130 @@
+import re
+from typing import NamedTuple
+
+from .config import Policy
+
+METHOD_BITS: dict[str, int] = {
+    m: 1 << i for i, m in enumerate(["GET", "DELETE", "PATCH", "POST", "PUT", "HEAD", "OPTIONS", "CONNECT", "TRACE"])
+}
+
+REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+REGEX_QUANTIFIERS = set('*+?{')
+
+
+def method_mask(methods: list[str]) -> int:
+    mask = 0
+    for m in methods:
+        mask |= METHOD_BITS.get(m, 0)
+    return mask
+
+
+def literal_prefix(pattern: str) -> str:
+    '''
+    Longest literal string every match of `pattern` (with re.match) starts with
+    '''
+    if '|' in pattern:
+        return ''
+
+    prefix = []
+    for char in pattern.lstrip('^'):
+        if char in REGEX_SPECIAL:
+            if char in REGEX_QUANTIFIERS and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+class PrefixTrie:
+    def __init__(self) -> None:
+        self.__root: dict = {}
+
+    def insert(self, prefix: str, value: int) -> None:
+        node = self.__root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(value)
+
+    def collect(self, key: str) -> list[int]:
+        '''
+        Values of all inserted prefixes of `key`
+        '''
+        node = self.__root
+        result = list(node.get(None, ()))
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+            result.extend(node.get(None, ()))
+        return result
+
+
+class CompiledPolicy(NamedTuple):
+    order: int
+    policy: Policy
+    pattern: re.Pattern
+    methods: int
+
+
+class RouteMatch(NamedTuple):
+    whitelist: Policy | None = None
+    enforcing: Policy | None = None
+
+
+class RouteIndex:
+    '''
+    Policies compiled once into a trie by literal resource prefix.
+    Lookup touches only policies whose prefix matches the resource.
+    '''
+
+    def __init__(self, policies: list[Policy]) -> None:
+        self.__policies: list[CompiledPolicy] = []
+        self.__trie = PrefixTrie()
+
+        for order, p in enumerate(policies):
+            self.__policies.append(CompiledPolicy(order, p, re.compile(p.resource), method_mask(p.method_list)))
+            self.__trie.insert(literal_prefix(p.resource), order)
+
+    def match(self, resource: str, method: str) -> RouteMatch:
+        '''
+        First whitelist and first enforcing policy matching the request, in config order
+        '''
+        method_bit = METHOD_BITS.get(method, 0)
+        enforcing = None
+
+        for order in sorted(self.__trie.collect(resource)):
+            compiled = self.__policies[order]
+            if not compiled.methods & method_bit:
+                continue
+            if compiled.pattern.match(resource) is None:
+                continue
+
+            if compiled.policy.white_list:
+                return RouteMatch(compiled.policy, enforcing)
+            if enforcing is None:
+                enforcing = compiled.policy
+
+        return RouteMatch(None, enforcing)
+
+    def __len__(self) -> int:
+        return len(self.__policies)
+
+
+class KeyMatchIndex:
+    '''
+    Positions of policy objects matching a resource with casbin keyMatch
+    '''
+
+    def __init__(self, patterns: list[str]) -> None:
+        self.__exact: dict[str, list[int]] = {}
+        self.__trie = PrefixTrie()
+
+        for order, pattern in enumerate(patterns):
+            star = pattern.find('*')
+            if star == -1:
+                self.__exact.setdefault(pattern, []).append(order)
+            else:
+                self.__trie.insert(pattern[:star], order)
+
+    def match(self, resource: str) -> tuple[int, ...]:
+        return tuple(sorted(self.__trie.collect(resource) + self.__exact.get(resource, [])))
@@ -0,0 +1,424 @@
+import asyncio
+import logging
+import math
+import time
+from typing import AsyncIterator, Callable
+
+import httpx
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from .balancer import Endpoint, ServiceEndpoints
+from .coalescing import Coalescer
+from .compression import matching_etag
+from .policies.enforcer import EnforceResult
+from .response_cache import NOT_STORED_HEADERS, CachedResponse, ResponseCache, parse_cache_control, response_ttl
+from .metrics import STAGE_SECONDS, UPSTREAM_FAILURES
+from .resilience import CircuitOpen, backoff_delay
+from .upstream import UpstreamPool, UpstreamSaturated
+
+logger = logging.getLogger("policy-enforcement-service")
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS', 'TRACE'}
+IDEMPOTENT_METHODS = {'GET', 'HEAD'} #retried and hedged
+COALESCED_METHODS = {'GET', 'HEAD'}
+SATURATED_RETRY_AFTER = 1
+# meaningful for one connection only, never forwarded (RFC 9110 section 7.6.1)
+HOP_BY_HOP_HEADERS = {
+    b'connection', b'keep-alive', b'proxy-connection', b'proxy-authenticate', b'proxy-authorization',
+    b'te', b'trailer', b'transfer-encoding', b'upgrade',
+}
+
+
+class RequestBodyTooLarge(Exception):
+    pass
+
+
+async def limited_body_stream(request: Request, max_body_size: int) -> AsyncIterator[bytes]:
+    '''
+    Passes request body chunks through as upstream reads them, failing once the limit is crossed
+    '''
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_body_size:
+            raise RequestBodyTooLarge()
+        yield chunk
+
+
+async def request_content(request: Request, max_body_size: int, buffer_size: int) -> bytes | AsyncIterator[bytes]:
+    '''
+    Small bodies with known length are buffered, everything else is streamed upstream
+    '''
+    content_length = request.headers.get('content-length')
+    if content_length is None and 'transfer-encoding' not in request.headers:
+        return b''
+    if content_length is not None:
+        try:
+            length = int(content_length)
+        except ValueError:
+            length = None
+
+        if length is not None:
+            if length > max_body_size:
+                raise RequestBodyTooLarge()
+            if length <= buffer_size:
+                return await request.body()
+
+    return limited_body_stream(request, max_body_size)
+
+
+def without_hop_by_hop(raw_headers: list[tuple[bytes, bytes]]) -> list[tuple[bytes, bytes]]:
+    '''
+    Headers with hop-by-hop ones dropped, including those listed in Connection header
+    '''
+    dropped = set(HOP_BY_HOP_HEADERS)
+    for name, value in raw_headers:
+        if name.lower() == b'connection':
+            dropped.update(token.strip().lower() for token in value.split(b','))
+    return [(k, v) for k, v in raw_headers if k.lower() not in dropped]
+
+
+def upstream_url(base_url: str, request: Request) -> httpx.URL:
+    '''
+    Request url moved onto chosen upstream instance, keeping its path prefix
+    '''
+    base = httpx.URL(base_url)
+    return base.copy_with(
+        path=base.path.rstrip('/') + request.url.path,
+        query=request.url.query.encode("utf-8"),
+    )
+
+
+async def stream_and_close(rp_resp: httpx.Response, on_close: Callable[[], None]) -> AsyncIterator[bytes]:
+    '''
+    Streams upstream response body, closing it when streaming ends or client goes away
+    '''
+    try:
+        async for chunk in rp_resp.aiter_raw():
+            yield chunk
+    finally:
+        await rp_resp.aclose()
+        on_close()
+
+
+UPSTREAM_ERRORS = (RequestBodyTooLarge, UpstreamSaturated, CircuitOpen, httpx.TransportError)
+ERROR_KINDS = {UpstreamSaturated: 'saturated', CircuitOpen: 'circuit_open', httpx.ConnectError: 'connect'}
+
+
+def error_kind(error: Exception) -> str:
+    if type(error) in ERROR_KINDS:
+        return ERROR_KINDS[type(error)]
+    if isinstance(error, httpx.TimeoutException):
+        return 'timeout'
+    return 'transport'
+
+
+class ConnectTrace:
+    '''
+    httpcore trace hook timing new upstream connections
+    '''
+    __slots__ = ('service', 'route', 'started')
+
+    def __init__(self, service: str, route: str) -> None:
+        self.service: str = service
+        self.route: str = route
+        self.started: float = None
+
+    async def __call__(self, name: str, info: dict) -> None:
+        if name == 'connection.connect_tcp.started':
+            self.started = time.perf_counter()
+        elif name == 'connection.connect_tcp.complete' and self.started is not None:
+            STAGE_SECONDS.observe(time.perf_counter() - self.started, 'upstream_connect', self.service, self.route)
+
+
+class Proxy:
+    '''
+    Forwards allowed requests to upstream instance chosen by enforcer
+    '''
+
+    def __init__(self, upstream_pool: UpstreamPool, response_cache: ResponseCache, coalescer: Coalescer,
+                 max_body_size: int, buffer_size: int) -> None:
+        self.upstream_pool: UpstreamPool = upstream_pool
+        self.response_cache: ResponseCache = response_cache
+        self.coalescer: Coalescer = coalescer
+        self.max_body_size: int = max_body_size
+        self.buffer_size: int = buffer_size
+        self.__closing: set[asyncio.Task] = set()
+
+    async def forward(self, request: Request, result: EnforceResult) -> Response:
+        client = self.upstream_pool.client(result.service_name)
+        if client is None:
+            return JSONResponse(content={'message': 'Service unavailable'}, status_code=503)
+
+        if self.coalescer.enabled and result.subject is not None and request.method in COALESCED_METHODS:
+            key = self.coalescer.make_key(result.subject, result.service_name, request)
+            fetch = lambda: self.__forward_safe(request, result, client, self.coalescer.max_body_size)
+            return await self.coalescer.run(key, fetch, (result.service_name, result.route))
+
+        if self.response_cache.enabled and result.subject is not None and request.method not in SAFE_METHODS:
+            return await self.__forward_write(request, result, client)
+        return await self.__forward_safe(request, result, client)
+
+    async def __forward_safe(self, request: Request, result: EnforceResult, client: httpx.AsyncClient,
+                             buffer_limit: int = 0) -> Response:
+        if self.response_cache.enabled and result.subject is not None and request.method == 'GET':
+            return await self.__forward_cached(request, result, client, buffer_limit)
+        return await self.__forward(request, result, client, buffer_limit=buffer_limit)
+
+    async def __forward(self, request: Request, result: EnforceResult, client: httpx.AsyncClient,
+                        on_close: Callable[[], None] = None, buffer_limit: int = 0) -> Response:
+        try:
+            rp_resp, endpoint = await self.__send(request, result, client)
+        except UPSTREAM_ERRORS as E:
+            return self.__error_response(E, result.service_name)
+
+        def close():
+            self.upstream_pool.release(endpoint)
+            if on_close is not None:
+                on_close()
+
+        return await self.__respond(rp_resp, close, buffer_limit)
+
+    async def __respond(self, rp_resp: httpx.Response, close: Callable[[], None], buffer_limit: int) -> Response:
+        '''
+        Upstream response streamed to client, or read whole when it has known length up to buffer_limit
+        '''
+        content_length = rp_resp.headers.get('content-length', '')
+        if not (content_length.isdigit() and int(content_length) <= buffer_limit):
+            response = StreamingResponse(stream_and_close(rp_resp, close), status_code=rp_resp.status_code)
+            response.raw_headers = without_hop_by_hop(rp_resp.headers.raw)
+            return response
+
+        try:
+            body = b''.join([chunk async for chunk in rp_resp.aiter_raw()])
+        finally:
+            await rp_resp.aclose()
+            close()
+        response = Response(content=body, status_code=rp_resp.status_code)
+        response.raw_headers = without_hop_by_hop(rp_resp.headers.raw)
+        return response
+
+    async def __forward_write(self, request: Request, result: EnforceResult, client: httpx.AsyncClient) -> Response:
+        invalidate = lambda: self.response_cache.invalidate(result.subject, result.service_name)
+        # before sending so nothing stale is served meanwhile, after finishing for reads that raced with it
+        invalidate()
+        return await self.__forward(request, result, client, on_close=invalidate)
+
+    async def __forward_cached(self, request: Request, result: EnforceResult, client: httpx.AsyncClient,
+                               buffer_limit: int = 0) -> Response:
+        request_directives = parse_cache_control(request.headers.get('cache-control'))
+        if 'no-store' in request_directives:
+            return await self.__forward(request, result, client, buffer_limit=buffer_limit)
+
+        cache = self.response_cache
+        key = cache.make_key(result.subject, result.service_name, request.url.path, request.url.query, request.headers)
+        entry = cache.get(key)
+        if entry is not None and entry.fresh and 'no-cache' not in request_directives:
+            return self.__cached_response(request, entry, b'HIT')
+
+        extra_headers = {'if-none-match': entry.etag} if entry is not None and entry.etag else None
+        fetched_at_epoch = cache.epoch
+        fetched_at = time.monotonic()
+        try:
+            rp_resp, endpoint = await self.__send(request, result, client, extra_headers)
+        except UPSTREAM_ERRORS as E:
+            return self.__error_response(E, result.service_name)
+
+        ttl = response_ttl(rp_resp.headers, result.cache_ttl)
+        if rp_resp.status_code == 304 and extra_headers is not None:
+            await rp_resp.aclose()
+            self.upstream_pool.release(endpoint)
+            refreshed = cache.refresh(key, ttl or 0.0)
+            return self.__cached_response(request, refreshed or entry, b'REVALIDATED')
+
+        content_length = rp_resp.headers.get('content-length')
+        etag = rp_resp.headers.get('etag')
+        cacheable = (
+            rp_resp.status_code == 200
+            and ttl is not None
+            and (ttl > 0 or etag is not None)
+            and content_length is not None
+            and content_length.isdigit()
+            and int(content_length) <= cache.max_entry_bytes
+        )
+        if not cacheable:
+            return await self.__respond(rp_resp, lambda: self.upstream_pool.release(endpoint), buffer_limit)
+
+        try:
+            body = b''.join([chunk async for chunk in rp_resp.aiter_raw()])
+        finally:
+            await rp_resp.aclose()
+            self.upstream_pool.release(endpoint)
+
+        entry = CachedResponse(
+            status_code=rp_resp.status_code,
+            headers=[
+                (k, v) for k, v in without_hop_by_hop(rp_resp.headers.raw)
+                if k.lower().decode() not in NOT_STORED_HEADERS and k.lower() != b'content-length'
+            ],
+            body=body,
+            etag=etag,
+            expires_at=time.monotonic() + ttl,
+            fetched_at=fetched_at,
+        )
+        cache.set(key, entry, fetched_at_epoch)
+        return self.__cached_response(request, entry, b'MISS', check_etag=False)
+
+    async def __send(self, request: Request, result: EnforceResult, client: httpx.AsyncClient,
+                     extra_headers: dict = None) -> tuple[httpx.Response, Endpoint]:
+        headers = httpx.Headers(without_hop_by_hop(request.headers.raw))
+        if 'accept-encoding' not in headers:
+            # otherwise httpx asks for gzip, which would reach a client that can not decode it
+            headers['accept-encoding'] = 'identity'
+        if extra_headers:
+            headers.update(extra_headers)
+        content = await request_content(request, self.max_body_size, self.buffer_size)
+
+        endpoints = self.upstream_pool.endpoints(result.service_name)
+        if endpoints is None or request.method not in IDEMPOTENT_METHODS or not isinstance(content, bytes):
+            return await self.__attempt(request, result, result.redirect_service, client, headers, content)
+
+        settings = endpoints.service.retry
+        url = result.redirect_service
+        tried = set()
+        for attempt in range(settings.attempts + 1):
+            last = attempt == settings.attempts
+            tried.add(url)
+            try:
+                rp_resp, endpoint = await self.__hedged(request, result, endpoints, url, client, headers, content, tried)
+            except (httpx.TransportError, CircuitOpen):
+                if last:
+                    raise
+            else:
+                if last or rp_resp.status_code not in settings.on_statuses:
+                    return rp_resp, endpoint
+                await rp_resp.aclose()
+                self.upstream_pool.release(endpoint)
+
+            endpoints.retries += 1
+            await asyncio.sleep(backoff_delay(attempt, settings.backoff, settings.max_backoff))
+            # prefer instance not tried yet, same one if there is no other
+            url = (endpoints.pick(exclude=tried) or endpoints.pick()).url
+
+    async def __hedged(self, request: Request, result: EnforceResult, endpoints: ServiceEndpoints, url: str,
+                       client: httpx.AsyncClient, headers: httpx.Headers, content: bytes,
+                       tried: set[str]) -> tuple[httpx.Response, Endpoint]:
+        '''
+        Sends second request to other instance when first one is slower than usual, first response wins
+        '''
+        delay = endpoints.hedge_delay()
+        if delay is None:
+            return await self.__attempt(request, result, url, client, headers, content)
+
+        pending = {asyncio.create_task(self.__attempt(request, result, url, client, headers, content))}
+        hedge_task = None
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            hedge = endpoints.pick(exclude=tried) if not done else None
+            if hedge is not None:
+                tried.add(hedge.url)
+                endpoints.hedges += 1
+                hedge_task = asyncio.create_task(self.__attempt(request, result, hedge.url, client, headers, content))
+                pending.add(hedge_task)
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [t for t in done if t.exception() is None]
+                error = next((t.exception() for t in done if t.exception() is not None), error)
+                if winners:
+                    for task in winners[1:]:
+                        self.__discard_attempt(task)
+                    if winners[0] is hedge_task:
+                        endpoints.hedge_wins += 1
+                    return winners[0].result()
+            raise error
+        finally:
+            for task in pending:
+                self.__discard_attempt(task)
+
+    async def __attempt(self, request: Request, result: EnforceResult, url: str, client: httpx.AsyncClient,
+                        headers: httpx.Headers, content) -> tuple[httpx.Response, Endpoint]:
+        try:
+            endpoint = self.upstream_pool.acquire(result.service_name, url)
+        except (UpstreamSaturated, CircuitOpen) as E:
+            UPSTREAM_FAILURES.inc(result.service_name, error_kind(E))
+            raise
+        rp_req = client.build_request(request.method, upstream_url(url, request), headers=headers, content=content)
+        rp_req.extensions['trace'] = ConnectTrace(result.service_name, result.route)
+        started = time.perf_counter()
+        success = None
+        try:
+            rp_resp = await client.send(rp_req, stream=True)
+        except httpx.TransportError as E:
+            success = False
+            UPSTREAM_FAILURES.inc(result.service_name, error_kind(E))
+            self.upstream_pool.release(endpoint)
+            raise
+        except BaseException:
+            self.upstream_pool.release(endpoint)
+            raise
+        else:
+            elapsed = time.perf_counter() - started
+            STAGE_SECONDS.observe(elapsed, 'upstream_ttfb', result.service_name, result.route)
+            if rp_resp.status_code >= 500:
+                UPSTREAM_FAILURES.inc(result.service_name, 'status')
+            if endpoint is not None:
+                success = not endpoint.breaker.is_failure(rp_resp.status_code, elapsed)
+                endpoints = self.upstream_pool.endpoints(result.service_name)
+                if endpoints is not None:
+                    endpoints.latency.record(elapsed)
+        finally:
+            if endpoint is not None:
+                endpoint.breaker.record(success)
+        return rp_resp, endpoint
+
+    def __discard_attempt(self, task: asyncio.Task) -> None:
+        task.cancel()
+        task.add_done_callback(self.__close_discarded)
+
+    def __close_discarded(self, task: asyncio.Task) -> None:
+        if task.cancelled() or task.exception() is not None:
+            return
+        rp_resp, endpoint = task.result()
+        self.upstream_pool.release(endpoint)
+        closing = asyncio.create_task(rp_resp.aclose())
+        self.__closing.add(closing)
+        closing.add_done_callback(self.__closing.discard)
+
+    @staticmethod
+    def __error_response(error: Exception, service_name: str) -> Response:
+        if isinstance(error, RequestBodyTooLarge):
+            return JSONResponse(content={'message': 'Request body too large'}, status_code=413)
+        if isinstance(error, UpstreamSaturated):
+            return JSONResponse(
+                content={'message': 'Service overloaded'}, status_code=503,
+                headers={'Retry-After': str(SATURATED_RETRY_AFTER)},
+            )
+        if isinstance(error, CircuitOpen):
+            return JSONResponse(
+                content={'message': 'Service unavailable'}, status_code=503,
+                headers={'Retry-After': str(max(math.ceil(error.retry_after), 1))},
+            )
+
+        logger.error(f"Error occured in upstream request to {service_name}: {error!r}")
+        if isinstance(error, httpx.TimeoutException):
+            return JSONResponse(content={'message': 'Gateway timeout'}, status_code=504)
+        return JSONResponse(content={'message': 'Bad gateway'}, status_code=502)
+
+    @staticmethod
+    def __cached_response(request: Request, entry: CachedResponse, cache_status: bytes,
+                          check_etag: bool = True) -> Response:
+        matched = matching_etag(request.headers.get('if-none-match'), entry.etag) if check_etag and entry.etag else None
+        if matched is not None:
+            response = Response(status_code=304)
+            response.raw_headers = [(b'etag', matched.encode('latin-1')), (b'x-cache', cache_status)]
+            return response
+
+        response = Response(content=entry.body, status_code=entry.status_code)
+        response.raw_headers = entry.headers + [
+            (b'content-length', str(len(entry.body)).encode()),
+            (b'x-cache', cache_status),
+        ]
+        return response
@@ -0,0 +1,145 @@
+import math
+import random
+import time
+from collections import deque
+
+from .policies.config import CircuitBreakerSettings
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f'circuit open, retry after {retry_after:.1f}s')
+        self.retry_after: float = retry_after
+
+
+class CircuitBreaker:
+    '''
+    Closed lets everything through and counts failures in a row,
+    open rejects until open_timeout passes, half open lets a few probes through.
+    '''
+
+    def __init__(self, settings: CircuitBreakerSettings) -> None:
+        self.settings: CircuitBreakerSettings = settings
+        self.failures: int = 0
+        self.opened_at: float = None
+        self.opened: int = 0
+        self.__half_open: bool = False
+        self.__probes: int = 0
+        self.__probe_successes: int = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if self.__half_open or time.monotonic() - self.opened_at >= self.settings.open_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    @property
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(self.settings.open_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+    def allow(self) -> bool:
+        '''
+        Whether a call may go through, half open state counts it as a probe
+        '''
+        if not self.settings.enabled:
+            return True
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == OPEN:
+            return False
+
+        self.__half_open = True
+        if self.__probes >= self.settings.half_open_requests:
+            return False
+        self.__probes += 1
+        return True
+
+    def record(self, success: bool | None) -> None:
+        '''
+        Outcome of an allowed call, None if upstream can not be judged by it (e.g. call was cancelled)
+        '''
+        if not self.settings.enabled:
+            return
+
+        if self.__half_open:
+            self.__probes = max(self.__probes - 1, 0)
+            if success is None:
+                return
+            if not success:
+                self.__open()
+                return
+            self.__probe_successes += 1
+            if self.__probe_successes >= self.settings.half_open_requests:
+                self.__close()
+            return
+
+        if success is None:
+            return
+        if success:
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.opened_at is None and self.failures >= self.settings.failure_threshold:
+            self.__open()
+
+    def is_failure(self, status_code: int, elapsed: float) -> bool:
+        threshold = self.settings.slow_call_threshold
+        return status_code in self.settings.failure_statuses or (threshold is not None and elapsed > threshold)
+
+    def __open(self) -> None:
+        self.opened_at = time.monotonic()
+        self.opened += 1
+        self.__half_open = False
+        self.__probes = 0
+        self.__probe_successes = 0
+
+    def __close(self) -> None:
+        self.opened_at = None
+        self.failures = 0
+        self.__half_open = False
+        self.__probes = 0
+        self.__probe_successes = 0
+
+
+class LatencyTracker:
+    '''
+    Recent latencies of a service, percentiles are recomputed every few samples
+    '''
+
+    def __init__(self, size: int = 1000, recompute_every: int = 50) -> None:
+        self.__samples: deque[float] = deque(maxlen=size)
+        self.__sorted: list[float] = []
+        self.__recompute_every: int = recompute_every
+        self.__since_recompute: int = 0
+
+    def record(self, seconds: float) -> None:
+        self.__samples.append(seconds)
+        self.__since_recompute += 1
+        if self.__since_recompute >= self.__recompute_every or len(self.__sorted) < self.__recompute_every:
+            self.__sorted = sorted(self.__samples)
+            self.__since_recompute = 0
+
+    def __len__(self) -> int:
+        return len(self.__samples)
+
+    def percentile(self, p: float) -> float | None:
+        if not self.__sorted:
+            return None
+        index = min(math.ceil(p / 100 * len(self.__sorted)) - 1, len(self.__sorted) - 1)
+        return self.__sorted[max(index, 0)]
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    '''
+    Exponential backoff with full jitter
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
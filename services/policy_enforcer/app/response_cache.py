@@ -0,0 +1,218 @@
+import multiprocessing
+import time
+from collections import OrderedDict
+from typing import Hashable, NamedTuple
+
+from .policies.cache import LRUCache
+from .shared_memory import SharedTable
+
+KEY_HEADERS = ('accept', 'accept-encoding')
+NOT_STORED_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'date', 'set-cookie'}
+
+
+class CachedResponse(NamedTuple):
+    status_code: int
+    headers: list[tuple[bytes, bytes]]
+    body: bytes
+    etag: str | None
+    expires_at: float
+    fetched_at: float = 0.0 #when upstream request was sent
+
+    @property
+    def fresh(self) -> bool:
+        return self.expires_at > time.monotonic()
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+
+def parse_cache_control(value: str | None) -> dict[str, str | None]:
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') or None
+    return directives
+
+
+def response_ttl(headers, default_ttl: float) -> float | None:
+    '''
+    How long upstream response may be served from cache, None if it must not be stored
+    '''
+    if headers.get('vary', '').strip() == '*':
+        return None
+    vary = {h.strip().lower() for h in headers.get('vary', '').split(',') if h.strip()}
+    if not vary <= set(KEY_HEADERS) | {'authorization'}:
+        return None
+
+    directives = parse_cache_control(headers.get('cache-control'))
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0.0
+    if 'max-age' in directives:
+        try:
+            return max(float(directives['max-age']), 0.0)
+        except (TypeError, ValueError):
+            return None
+    return default_ttl
+
+
+class SharedInvalidations:
+    '''
+    Time of last write of every subject to every service, shared by forked workers,
+    so a write through one worker drops responses cached by the others.
+    Writes forgotten to make room raise the floor, older responses count as invalidated.
+    Without the lock, a write raises the floor to now and a read counts everything as invalidated,
+    so a stuck lock costs cache hits but never serves responses older than a write.
+    '''
+
+    def __init__(self, size: int) -> None:
+        self.__table: SharedTable = SharedTable('invalidations', size, fields=1, age_field=0)
+        self.__floor = multiprocessing.RawValue('d', 0.0)
+
+    def invalidate(self, subject: str, service: str) -> None:
+        key_hash = self.__table.key_hash((subject, service))
+        with self.__table.locked() as acquired:
+            if not acquired:
+                self.__floor.value = max(self.__floor.value, time.monotonic())
+                return
+            index, values, evicted = self.__table.find(key_hash)
+            if evicted is not None:
+                self.__floor.value = max(self.__floor.value, evicted[0])
+            self.__table.write(index, key_hash, (time.monotonic(),), new=values is None and evicted is None)
+
+    @property
+    def lock_misses(self) -> int:
+        return self.__table.lock_misses
+
+    def invalidated_at(self, subject: str, service: str) -> float:
+        key_hash = self.__table.key_hash((subject, service))
+        with self.__table.locked() as acquired:
+            if not acquired:
+                return time.monotonic()
+            _, values, _ = self.__table.find(key_hash)
+            floor = self.__floor.value
+        return max(values[0], floor) if values is not None else floor
+
+
+class ResponseCache:
+    '''
+    Per-subject cache of upstream GET responses, bounded by total size in bytes.
+    Any write of a subject to a service drops cached responses of that subject from that service.
+    '''
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int) -> None:
+        self.max_bytes: int = max_bytes
+        self.max_entry_bytes: int = max_entry_bytes
+        self.bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.revalidations: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+        # increments on every invalidation, responses fetched across a write of their owner are not stored
+        self.epoch: int = 0
+        self.__invalidated_at: LRUCache = LRUCache(100000)
+        # set before workers fork when gateway runs several of them
+        self.shared: SharedInvalidations | None = None
+        self.__entries: OrderedDict[Hashable, CachedResponse] = OrderedDict()
+        self.__owners: dict[tuple[str, str], set[Hashable]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(subject: str, service: str, path: str, query: str, headers) -> tuple:
+        return (subject, service, path, query) + tuple(headers.get(h, '') for h in KEY_HEADERS)
+
+    def get(self, key: tuple) -> CachedResponse | None:
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if self.shared is not None and self.shared.invalidated_at(*key[:2]) >= entry.fetched_at:
+            self.__discard(key)
+            self.misses += 1
+            return None
+        self.__entries.move_to_end(key)
+        if entry.fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def set(self, key: tuple, entry: CachedResponse, fetched_at_epoch: int) -> None:
+        if entry.size > self.max_entry_bytes:
+            return
+        if self.__invalidated_at.get(key[:2], 0) > fetched_at_epoch:
+            return
+        if self.shared is not None and self.shared.invalidated_at(*key[:2]) >= entry.fetched_at:
+            return
+
+        self.__discard(key)
+        self.__entries[key] = entry
+        self.__owners.setdefault(key[:2], set()).add(key)
+        self.bytes += entry.size
+
+        while self.bytes > self.max_bytes and self.__entries:
+            oldest = next(iter(self.__entries))
+            self.__discard(oldest)
+            self.evictions += 1
+
+    def refresh(self, key: tuple, ttl: float) -> CachedResponse | None:
+        '''
+        Extend cached response after upstream confirmed it is not modified
+        '''
+        entry = self.__entries.get(key)
+        if entry is None:
+            return None
+        self.revalidations += 1
+        entry = entry._replace(expires_at=time.monotonic() + ttl)
+        self.__entries[key] = entry
+        return entry
+
+    def invalidate(self, subject: str, service: str) -> None:
+        self.epoch += 1
+        self.__invalidated_at.set((subject, service), self.epoch)
+        if self.shared is not None:
+            self.shared.invalidate(subject, service)
+
+        keys = self.__owners.pop((subject, service), None)
+        if not keys:
+            return
+        self.invalidations += 1
+        for key in keys:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry.size
+
+    def __discard(self, key: tuple) -> None:
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        owners = self.__owners.get(key[:2])
+        if owners is not None:
+            owners.discard(key)
+            if not owners:
+                del self.__owners[key[:2]]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.__entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'shared_lock_misses': self.shared.lock_misses if self.shared is not None else 0,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
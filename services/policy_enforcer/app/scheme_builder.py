@@ -1,5 +1,13 @@
+import asyncio
+import hashlib
+import logging
 from json import dumps
 
+from .policies.config import Service
+from .upstream import UpstreamPool
+
+logger = logging.getLogger("policy-enforcement-service")
+
 class SchemeBuilder:
     def __init__(self, source_scheme: dict) -> None:
         self.__result: dict = source_scheme
@@ -21,4 +29,44 @@ class SchemeBuilder:
 
     @property
     def result(self):
-        return self.__result
\ No newline at end of file
+        return self.__result
+
+
+class SchemeCache:
+    '''
+    Merged openapi scheme of all services, kept ready to serve with its ETag
+    '''
+
+    def __init__(self, fetch_timeout: float) -> None:
+        self.fetch_timeout: float = fetch_timeout
+        self.result: dict = None
+        self.body: bytes = None
+        self.etag: str = None
+        self.__service_schemes: dict[str, dict] = {}
+
+    async def refresh(self, source_scheme: dict, services: list[Service], pool: UpstreamPool) -> None:
+        schemes = await asyncio.gather(*(self.__fetch(s, pool) for s in services))
+
+        service_schemes = {}
+        scheme_builder = SchemeBuilder(source_scheme)
+        for service, scheme in zip(services, schemes):
+            if scheme is None: #keep last known scheme of unavailable service
+                scheme = self.__service_schemes.get(service.name)
+            if scheme is None:
+                continue
+            service_schemes[service.name] = scheme
+            scheme_builder.append(scheme, inject_token_in_swagger=service.inject_token_in_swagger)
+
+        self.__service_schemes = service_schemes
+        self.result = scheme_builder.result
+        self.body = dumps(self.result).encode()
+        self.etag = f'"{hashlib.sha1(self.body).hexdigest()}"'
+
+    async def __fetch(self, service: Service, pool: UpstreamPool) -> dict | None:
+        try:
+            resp = await pool.client(service.name).get(service.openapi_scheme, timeout=self.fetch_timeout)
+            resp.raise_for_status()
+            return resp.json()
+        except Exception as E:
+            logger.error(f"Error occured in fetching openapi scheme of {service.name}: {E}")
+            return None
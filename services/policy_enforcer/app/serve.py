@@ -0,0 +1,174 @@
+'''
+Production entry point running several gateway workers:
+    python -m app.serve --host 0.0.0.0 --port 5010
+
+Master process loads settings and policies once, then forks WORKERS workers
+(one per cpu by default) sharing that memory copy-on-write. Every worker listens
+on its own SO_REUSEPORT socket, so the kernel spreads connections between them.
+Rate limit buckets and response cache invalidations live in shared memory,
+other caches, metrics and stats are per worker.
+POST /gateway/reload is passed to master as SIGHUP, master reloads its own policies
+(workers forked later start with them) and sends SIGHUP on to every worker.
+Crashed workers are forked again from the preloaded master right away.
+'''
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+from .logs import flush_logs
+
+logger = logging.getLogger("policy-enforcement-service")
+
+# workers dying sooner than this after start are restarted with a delay
+MIN_WORKER_LIFETIME = 1.0
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_worker(gateway, host: str, port: int, log_level: str) -> int:
+    # signals are handled by uvicorn server from here on
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # ignored until gateway startup installs its reload handler
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # own process group, so ctrl+c reaches master only and workers get one SIGTERM from it
+    os.setpgid(0, 0)
+    gc.enable()
+    try:
+        sock = bind_socket(host, port)
+        sock.listen(2048)
+    except OSError as E:
+        logger.error(f"Error occured in worker {os.getpid()} socket bind: {E}")
+        return 1
+
+    # uvicorn logs go through gateway logging, access records come from its middleware
+    server = uvicorn.Server(uvicorn.Config(gateway.app, log_level=log_level, log_config=None, access_log=False))
+    server.run(sockets=[sock])
+    return 0
+
+
+class Supervisor:
+    '''
+    Forks workers from preloaded master and keeps their number until stopped
+    '''
+
+    def __init__(self, gateway, workers: int, host: str, port: int, log_level: str) -> None:
+        self.gateway = gateway
+        self.workers: int = workers
+        self.host: str = host
+        self.port: int = port
+        self.log_level: str = log_level
+        self.stopping: bool = False
+        self.__started_at: dict[int, float] = {}
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, self.__stop)
+        signal.signal(signal.SIGTERM, self.__stop)
+        signal.signal(signal.SIGHUP, self.__reload)
+        for _ in range(self.workers):
+            self.__spawn()
+        logger.info(f"Gateway master {os.getpid()} serving on {self.host}:{self.port} with {self.workers} workers")
+
+        while self.__started_at:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started_at = self.__started_at.pop(pid, None)
+            if started_at is None or self.stopping:
+                continue
+
+            logger.warning(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+            if time.monotonic() - started_at < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            if not self.stopping:
+                self.__spawn()
+
+    def __spawn(self) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = run_worker(self.gateway, self.host, self.port, self.log_level)
+            finally:
+                flush_logs()
+                os._exit(code)
+        self.__started_at[pid] = time.monotonic()
+
+    def __reload(self, signum, frame) -> None:
+        try:
+            self.gateway.policy_checker.reload_blocking()
+        except Exception as E:
+            logger.error(f"Error occured in master policies reload, keeping previous policies: {E}")
+        logger.info(f"Gateway master reloading policies of {len(self.__started_at)} workers")
+        for pid in self.__started_at:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def __stop(self, signum, frame) -> None:
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info(f"Gateway master stopping {len(self.__started_at)} workers")
+        for pid in self.__started_at:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def preload():
+    '''
+    Import gateway app in master, with state shared between workers put into shared memory
+    '''
+    from . import app as gateway
+    from .policies.rate_limit import SharedRateLimiter
+    from .response_cache import SharedInvalidations
+
+    gateway.policy_checker.rate_limiter = SharedRateLimiter(gateway.app_config.rate_limit_buckets)
+    gateway.response_cache.shared = SharedInvalidations(100000)
+    gateway.reload_broadcast = lambda: os.kill(os.getppid(), signal.SIGHUP)
+    return gateway
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Policy enforcement gateway with several workers')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5010)
+    parser.add_argument('--workers', type=int, default=None, help='overrides WORKERS setting')
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args()
+
+    gc.disable()
+    gateway = preload()
+    workers = args.workers or gateway.app_config.workers or os.cpu_count() or 1
+
+    # fail fast instead of restarting workers that can not bind
+    try:
+        bind_socket(args.host, args.port).close()
+    except OSError as E:
+        logger.error(f"Error occured in gateway start, can not listen on {args.host}:{args.port}: {E}")
+        sys.exit(1)
+
+    # objects created so far are never collected, so collector does not touch pages shared with workers
+    gc.freeze()
+    Supervisor(gateway, workers, args.host, args.port, args.log_level).run()
+
+
+if __name__ == '__main__':
+    main()
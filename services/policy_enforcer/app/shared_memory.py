@@ -0,0 +1,108 @@
+import contextlib
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+from typing import Hashable, Iterator
+
+from .metrics import SHARED_LOCK_MISSES
+
+logger = logging.getLogger("policy-enforcement-service")
+
+# slots checked for a key before the least recently updated of them is replaced
+PROBES = 8
+# non-blocking tries for the lock, yielding cpu between them. It is held for microseconds, so they fail
+# only when its holder was killed holding it (semaphores are not released then) and the event loop must not wait
+LOCK_ATTEMPTS = 20
+# seconds between warnings about lock misses of one worker
+LOCK_WARNING_INTERVAL = 10.0
+
+HEADER = struct.Struct('Q') #used slots
+
+
+class SharedTable:
+    '''
+    Fixed size hash table of float records in anonymous shared memory.
+
+    Created in master process before workers are forked, so every worker maps the same pages.
+    Keys are stored as 64 bit hashes, a full neighbourhood of probed slots gives up
+    its least recently updated record. Callers hold lock while reading and writing a record,
+    and go on without shared state when it is not acquired in LOCK_ATTEMPTS tries.
+    '''
+
+    def __init__(self, name: str, slots: int, fields: int, age_field: int) -> None:
+        self.name: str = name
+        self.slots: int = max(slots, 1)
+        self.age_field: int = age_field
+        self.lock = multiprocessing.Lock()
+        self.lock_misses: int = 0 #of this worker
+        self.__warned_at: float = 0.0
+        self.__record: struct.Struct = struct.Struct(f'Q{fields}d')
+        self.__memory: mmap.mmap = mmap.mmap(-1, HEADER.size + self.slots * self.__record.size)
+
+    @contextlib.contextmanager
+    def locked(self) -> Iterator[bool]:
+        '''
+        Holds lock for the block, yields False without holding it when it is not acquired in LOCK_ATTEMPTS tries
+        '''
+        for _ in range(LOCK_ATTEMPTS):
+            if self.lock.acquire(block=False):
+                break
+            os.sched_yield()
+        else:
+            self.__missed()
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.lock.release()
+
+    def __missed(self) -> None:
+        self.lock_misses += 1
+        SHARED_LOCK_MISSES.inc(self.name)
+        now = time.monotonic()
+        if now - self.__warned_at >= LOCK_WARNING_INTERVAL:
+            self.__warned_at = now
+            logger.warning(
+                f"Shared {self.name} lock not acquired by worker {os.getpid()} ({self.lock_misses} times), "
+                f"using worker state. Restart gateway if it keeps happening, a worker may have died holding it"
+            )
+
+    @staticmethod
+    def key_hash(key: Hashable) -> int:
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') or 1
+
+    def find(self, key_hash: int) -> tuple[int, tuple | None, tuple | None]:
+        '''
+        Slot index of the key with its values, or slot to store the key in
+        with values of the record it replaces (None for an empty slot)
+        '''
+        start = key_hash % self.slots
+        victim, victim_values = None, None
+        for i in range(min(PROBES, self.slots)):
+            index = (start + i) % self.slots
+            stored, *values = self.__record.unpack_from(self.__memory, self.__offset(index))
+            if stored == key_hash:
+                return index, tuple(values), None
+            if stored == 0:
+                return index, None, None
+            if victim is None or values[self.age_field] < victim_values[self.age_field]:
+                victim, victim_values = index, tuple(values)
+        return victim, None, victim_values
+
+    def write(self, index: int, key_hash: int, values: tuple, new: bool) -> None:
+        self.__record.pack_into(self.__memory, self.__offset(index), key_hash, *values)
+        if new:
+            HEADER.pack_into(self.__memory, 0, self.used + 1)
+
+    @property
+    def used(self) -> int:
+        return HEADER.unpack_from(self.__memory, 0)[0]
+
+    def __offset(self, index: int) -> int:
+        return HEADER.size + index * self.__record.size
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import urllib.parse
+
+import httpx
+
+from .balancer import Endpoint, ServiceEndpoints
+from .policies.config import PoolSettings, Service
+from .resilience import CircuitOpen
+
+logger = logging.getLogger("policy-enforcement-service")
+
+
+class UpstreamSaturated(Exception):
+    pass
+
+
+class UpstreamPool:
+    '''
+    Long-lived pooled http clients, one per service from policies config
+    '''
+
+    def __init__(self, drain_timeout: float = 60.0) -> None:
+        self.drain_timeout: float = drain_timeout
+        self.__services: dict[str, Service] = {}
+        self.__clients: dict[str, httpx.AsyncClient] = {}
+        self.__transports: dict[str, httpx.AsyncHTTPTransport] = {}
+        self.__endpoints: dict[str, ServiceEndpoints] = {}
+        self.__health_tasks: dict[str, asyncio.Task] = {}
+        self.__retired: set[httpx.AsyncClient] = set()
+        self.__drain_tasks: set[asyncio.Task] = set()
+
+    def open(self, services: list[Service]) -> None:
+        self.sync(services)
+
+    def sync(self, services: list[Service]) -> None:
+        '''
+        Open clients for new or changed services. Clients no longer needed
+        are closed after drain timeout, so in-flight streams can finish.
+        '''
+        wanted = {s.name: s for s in services}
+
+        for name in list(self.__clients):
+            if wanted.get(name) != self.__services[name]:
+                self.__retire(name)
+
+        for name, service in wanted.items():
+            if name not in self.__clients:
+                self.__open_client(service)
+
+    async def close(self) -> None:
+        for task in self.__drain_tasks:
+            task.cancel()
+        for task in self.__health_tasks.values():
+            task.cancel()
+        self.__health_tasks.clear()
+        for client in self.__retired:
+            await client.aclose()
+        self.__retired.clear()
+
+        for name, client in self.__clients.items():
+            await client.aclose()
+            logger.info(f"Upstream pool closed for {name}")
+        self.__services.clear()
+        self.__clients.clear()
+        self.__transports.clear()
+        self.__endpoints.clear()
+
+    def client(self, service_name: str) -> httpx.AsyncClient | None:
+        return self.__clients.get(service_name)
+
+    def endpoints(self, service_name: str) -> ServiceEndpoints | None:
+        return self.__endpoints.get(service_name)
+
+    def select(self, service: Service) -> str:
+        '''
+        Url of the service instance that should get next request
+        '''
+        endpoints = self.__endpoints.get(service.name)
+        if endpoints is None:
+            return service.entrypoint.unicode_string()
+        return endpoints.pick().url
+
+    def acquire(self, service_name: str, url: str) -> Endpoint | None:
+        '''
+        Count request as in flight to the instance, raises UpstreamSaturated
+        when service already has max_concurrency requests in flight
+        and CircuitOpen when the instance is failing
+        '''
+        endpoints = self.__endpoints.get(service_name)
+        if endpoints is not None and endpoints.saturated:
+            endpoints.rejected += 1
+            raise UpstreamSaturated()
+        endpoint = endpoints.by_url.get(url) if endpoints is not None else None
+        if endpoint is not None:
+            if not endpoint.breaker.allow():
+                raise CircuitOpen(endpoint.breaker.retry_after)
+            endpoint.outstanding += 1
+        return endpoint
+
+    @staticmethod
+    def release(endpoint: Endpoint | None) -> None:
+        if endpoint is not None:
+            endpoint.outstanding -= 1
+
+    def stats(self) -> dict:
+        result = {}
+        for name, transport in self.__transports.items():
+            # httpx does not expose pool state, so read it from the httpcore pool
+            pool = getattr(transport, '_pool', None)
+            connections = list(getattr(pool, 'connections', []))
+            idle = sum(1 for c in connections if c.is_idle())
+            endpoints = self.__endpoints[name]
+            result[name] = {
+                **endpoints.stats(),
+                'http2': self.__services[name].http2,
+                'connections': len(connections),
+                'active': len(connections) - idle,
+                'idle': idle,
+                'queued_requests': sum(1 for r in getattr(pool, '_requests', []) if r.connection is None),
+                'endpoints': [e.stats() for e in endpoints.endpoints],
+            }
+        return result
+
+    def __open_client(self, service: Service) -> None:
+        # http2 on plain http urls means prior knowledge, streams of many requests share a connection
+        transport = httpx.AsyncHTTPTransport(
+            limits=self.__make_limits(service.pool),
+            http1=not service.http2,
+            http2=service.http2,
+        )
+        self.__services[service.name] = service
+        self.__transports[service.name] = transport
+        self.__clients[service.name] = httpx.AsyncClient(
+            base_url=service.entrypoint.unicode_string(),
+            transport=transport,
+            timeout=self.__make_timeout(service.pool),
+        )
+        self.__endpoints[service.name] = ServiceEndpoints(service)
+        if service.health_check.enabled:
+            self.__health_tasks[service.name] = asyncio.create_task(self.__health_check_loop(service))
+        protocol = 'HTTP/2' if service.http2 else 'HTTP/1.1'
+        logger.info(f"Upstream pool opened for {service.name} {service.endpoints} over {protocol}: {service.pool}")
+
+    def __retire(self, name: str) -> None:
+        client = self.__clients.pop(name)
+        self.__services.pop(name)
+        self.__transports.pop(name)
+        self.__endpoints.pop(name)
+        health_task = self.__health_tasks.pop(name, None)
+        if health_task is not None:
+            health_task.cancel()
+        self.__retired.add(client)
+
+        task = asyncio.create_task(self.__close_after_drain(name, client))
+        self.__drain_tasks.add(task)
+        task.add_done_callback(self.__drain_tasks.discard)
+
+    async def __close_after_drain(self, name: str, client: httpx.AsyncClient) -> None:
+        await asyncio.sleep(self.drain_timeout)
+        await client.aclose()
+        self.__retired.discard(client)
+        logger.info(f"Retired upstream pool closed for {name}")
+
+    async def __health_check_loop(self, service: Service) -> None:
+        client = self.__clients[service.name]
+        endpoints = self.__endpoints[service.name]
+        settings = service.health_check
+
+        while True:
+            await asyncio.gather(*(self.__check_endpoint(client, e, service) for e in endpoints.endpoints))
+            await asyncio.sleep(settings.interval)
+
+    async def __check_endpoint(self, client: httpx.AsyncClient, endpoint: Endpoint, service: Service) -> None:
+        settings = service.health_check
+        try:
+            resp = await client.get(urllib.parse.urljoin(endpoint.url, settings.path), timeout=settings.timeout)
+            passed = resp.status_code < 500
+        except httpx.HTTPError:
+            passed = False
+
+        if passed:
+            endpoint.failures = 0
+            endpoint.successes += 1
+            if not endpoint.healthy and endpoint.successes >= settings.healthy_threshold:
+                endpoint.healthy = True
+                logger.info(f"Upstream {endpoint.url} of {service.name} is healthy again")
+        else:
+            endpoint.successes = 0
+            endpoint.failures += 1
+            if endpoint.healthy and endpoint.failures >= settings.unhealthy_threshold:
+                endpoint.healthy = False
+                logger.warning(f"Upstream {endpoint.url} of {service.name} is unhealthy, taken out of rotation")
+
+    @staticmethod
+    def __make_limits(settings: PoolSettings) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=settings.max_connections,
+            max_keepalive_connections=settings.max_keepalive_connections,
+            keepalive_expiry=settings.keepalive_expiry,
+        )
+
+    @staticmethod
+    def __make_timeout(settings: PoolSettings) -> httpx.Timeout:
+        return httpx.Timeout(
+            connect=settings.connect_timeout,
+            read=settings.read_timeout,
+            write=settings.write_timeout,
+            pool=settings.pool_timeout,
+        )
@@ -0,0 +1,134 @@
+'''
+Upstream HTTP/1.1 keep-alive against HTTP/2 (h2c) benchmark.
+
+Starts stub upstream on hypercorn, which serves both protocols on one port,
+and sends the same concurrent load through gateway upstream pool opened
+with http2 off and on. Reports peak connection count and latency percentiles:
+    python -m bench.http2_upstream
+    python -m bench.http2_upstream --concurrency 200 --requests 10000 --delay-ms 20
+'''
+import argparse
+import asyncio
+import math
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+
+from app.policies.config import HealthCheck, PoolSettings, Service
+from app.upstream import UpstreamPool
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    index = min(math.ceil(p / 100 * len(sorted_values)) - 1, len(sorted_values) - 1)
+    return sorted_values[max(index, 0)]
+
+
+async def wait_for_upstream(url: str, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def run(url: str, http2: bool, concurrency: int, requests: int, max_connections: int) -> dict:
+    service = Service(
+        name='bench',
+        entrypoint=url,
+        http2=http2,
+        health_check=HealthCheck(enabled=False),
+        pool=PoolSettings(max_connections=max_connections, max_keepalive_connections=max_connections),
+    )
+    pool = UpstreamPool()
+    pool.open([service])
+    client = pool.client(service.name)
+
+    latencies = []
+    errors = 0
+    peak_connections = 0
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for i in remaining:
+            started = time.perf_counter()
+            try:
+                resp = await client.get(f'/todo/{i}')
+                resp.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    async def sample_connections() -> None:
+        nonlocal peak_connections
+        while True:
+            peak_connections = max(peak_connections, pool.stats()[service.name]['connections'])
+            await asyncio.sleep(0.005)
+
+    sampler = asyncio.create_task(sample_connections())
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    await pool.close()
+
+    latencies.sort()
+    return {
+        'protocol': 'HTTP/2' if http2 else 'HTTP/1.1',
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'peak_connections': peak_connections,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+    }
+
+
+async def compare(args) -> list[dict]:
+    url = f'http://127.0.0.1:{args.port}/'
+    await wait_for_upstream(url + 'openapi.json')
+    # warm up interpreter and upstream before measuring
+    await run(url, False, 10, 200, args.max_connections)
+    return [
+        await run(url, http2, args.concurrency, args.requests, args.max_connections)
+        for http2 in (False, True)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upstream HTTP/1.1 against HTTP/2 benchmark')
+    parser.add_argument('--port', type=int, default=5902)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--delay-ms', type=float, default=10, help='upstream delay before every response')
+    parser.add_argument('--max-connections', type=int, default=100, help='pool limit of both runs')
+    args = parser.parse_args()
+
+    upstream = subprocess.Popen([
+        sys.executable, '-m', 'bench.stub_upstream', '--server', 'hypercorn',
+        '--port', str(args.port), '--name', 'bench', '--delay-ms', str(args.delay_ms),
+    ])
+    try:
+        results = asyncio.run(compare(args))
+    finally:
+        upstream.send_signal(signal.SIGINT)
+        upstream.wait()
+
+    for r in results:
+        print(
+            f"{r['protocol']:>8}: {r['requests']} requests, {r['errors']} errors, {r['rps']:.0f} rps, "
+            f"peak connections {r['peak_connections']}, p50 {r['p50_ms']:.1f} ms, p99 {r['p99_ms']:.1f} ms"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+'''
+Load test of the gateway against local stub upstreams.
+
+Starts stub user-service and todo-service (responses about the size of real ones),
+gateway with bench/load_policies.yaml, and runs every scenario at fixed concurrency:
+    python -m bench.load --output results.json
+    python -m bench.load --scenario authorized --scenario denied --duration 5 --concurrency 64
+    python -m bench.load --workers 4 --baseline results.json
+
+Results are written as json: throughput, status counts and latency percentiles per scenario,
+output of gateway and stubs goes next to it with .log suffix.
+With --baseline, scenarios whose throughput dropped or p99 grew by more than
+--max-regression compared to the baseline make the run exit with status 1.
+Requests ask for identity encoding unless --accept-encoding says otherwise, so received
+bytes are body sizes; the encoding is recorded in results and checked against the baseline.
+'''
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from collections import Counter
+from typing import NamedTuple
+
+import httpx
+import jwt
+
+JWT_SECRET = 'load-test-secret'
+POLICIES = 'bench/load_policies.yaml'
+USERS_PORT = 5911
+TODO_PORT = 5912
+GATEWAY_PORT = 5910
+
+# approximate bodies of user-service user object and todo-service task list
+USERS_BODY_BYTES = 400
+TODO_BODY_BYTES = 4096
+STREAM_BYTES = 256 * 1024
+
+
+class Call(NamedTuple):
+    method: str
+    path: str
+    token: str | None #'user' or None
+    body: dict | None = None
+
+
+SCENARIOS: dict[str, list[tuple[int, Call]]] = {
+    'whitelisted': [
+        (1, Call('POST', '/auth/jwt/login', None, {'username': 'user@example.com', 'password': 'password'})),
+    ],
+    'authorized': [
+        (3, Call('GET', '/todo/tasks', 'user')),
+        (1, Call('GET', '/users/me', 'user')),
+        (1, Call('POST', '/todo/tasks', 'user', {'title': 'Buy milk', 'section_id': 1})),
+    ],
+    'denied': [
+        (1, Call('GET', '/groups', 'user')), #policy rule fails
+        (1, Call('GET', '/todo/tasks', None)), #no token
+        (1, Call('GET', '/unknown', 'user')), #no policy
+    ],
+    'streaming': [
+        (1, Call('GET', f'/todo/export?stream={STREAM_BYTES}', 'user')),
+    ],
+}
+SCENARIOS['mixed'] = [
+    (1, SCENARIOS['whitelisted'][0][1]),
+    *((w * 4, c) for w, c in SCENARIOS['authorized']),
+    *SCENARIOS['denied'],
+    (1, SCENARIOS['streaming'][0][1]),
+]
+
+
+def make_tokens(users: int) -> dict[str, list[str]]:
+    exp = int(time.time()) + 3600
+    return {
+        'user': [jwt.encode({'sub': str(i), 'group_id': 0, 'exp': exp}, JWT_SECRET, 'HS256') for i in range(users)],
+    }
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    index = min(math.ceil(p / 100 * len(sorted_values)) - 1, len(sorted_values) - 1)
+    return sorted_values[max(index, 0)]
+
+
+async def run_scenario(client: httpx.AsyncClient, mix: list[tuple[int, Call]], tokens: dict[str, list[str]],
+                       concurrency: int, duration: float, warmup: float) -> dict:
+    weights = [w for w, _ in mix]
+    calls = [c for _, c in mix]
+    latencies: list[float] = []
+    statuses: Counter = Counter()
+    errors = 0
+    received = 0
+    measuring = False
+
+    async def worker(seed: int) -> None:
+        nonlocal errors, received
+        rnd = random.Random(seed)
+        while not stopped.is_set():
+            call = rnd.choices(calls, weights)[0]
+            headers = {'Authorization': f'Bearer {rnd.choice(tokens[call.token])}'} if call.token else {}
+            started = time.perf_counter()
+            try:
+                async with client.stream(call.method, call.path, headers=headers, json=call.body) as resp:
+                    size = 0
+                    async for chunk in resp.aiter_raw():
+                        size += len(chunk)
+            except httpx.HTTPError:
+                if measuring:
+                    errors += 1
+                continue
+            if measuring:
+                latencies.append(time.perf_counter() - started)
+                statuses[resp.status_code] += 1
+                received += size
+
+    stopped = asyncio.Event()
+    workers = [asyncio.create_task(worker(i)) for i in range(concurrency)]
+    await asyncio.sleep(warmup)
+    measuring = True
+    started = time.perf_counter()
+    await asyncio.sleep(duration)
+    measuring = False
+    elapsed = time.perf_counter() - started
+    stopped.set()
+    await asyncio.gather(*workers)
+
+    latencies.sort()
+    result = {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+        'rps': len(latencies) / elapsed,
+        'received_bytes_per_second': received / elapsed,
+    }
+    for p in (50, 95, 99):
+        result[f'p{p}_ms'] = percentile(latencies, p) * 1000 if latencies else None
+    result['max_ms'] = latencies[-1] * 1000 if latencies else None
+    return result
+
+
+async def run_all(args, base_url: str) -> dict:
+    tokens = make_tokens(args.users)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = {}
+    # httpx asks for gzip by default, received bytes would count whatever the gateway compressed
+    headers = {'Accept-Encoding': args.accept_encoding}
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30.0, headers=headers) as client:
+        for name in args.scenario or SCENARIOS:
+            results[name] = await run_scenario(
+                client, SCENARIOS[name], tokens, args.concurrency, args.duration, args.warmup
+            )
+            r = results[name]
+            print(
+                f"{name:>12}: {r['rps']:8.0f} rps, p50 {r['p50_ms']:7.2f} ms, p95 {r['p95_ms']:7.2f} ms, "
+                f"p99 {r['p99_ms']:7.2f} ms, errors {r['errors']}, statuses {r['statuses']}",
+                flush=True,
+            )
+    return results
+
+
+def start(command: list[str], log, env: dict = None) -> subprocess.Popen:
+    return subprocess.Popen(command, env={**os.environ, **(env or {})}, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def start_stack(args, log) -> list[subprocess.Popen]:
+    python = sys.executable
+    processes = [
+        start([python, '-m', 'bench.stub_upstream', '--port', str(USERS_PORT), '--name', 'users',
+               '--body-bytes', str(USERS_BODY_BYTES), '--delay-ms', str(args.upstream_delay_ms)], log),
+        start([python, '-m', 'bench.stub_upstream', '--port', str(TODO_PORT), '--name', 'todo',
+               '--body-bytes', str(TODO_BODY_BYTES), '--delay-ms', str(args.upstream_delay_ms)], log),
+    ]
+    env = {
+        'JWT_SECRET': JWT_SECRET,
+        'POLICIES_CONFIG_PATH': POLICIES,
+        'POLICIES_RELOAD_INTERVAL': '0',
+    }
+    if args.workers:
+        gateway = [python, '-m', 'app.serve', '--host', '127.0.0.1', '--port', str(GATEWAY_PORT),
+                   '--workers', str(args.workers), '--log-level', 'warning']
+    else:
+        gateway = [python, '-m', 'uvicorn', 'app.app:app', '--host', '127.0.0.1', '--port', str(GATEWAY_PORT),
+                   '--log-level', 'warning']
+    processes.append(start(gateway, log, env))
+
+    wait_ready(f'http://127.0.0.1:{USERS_PORT}/openapi.json')
+    wait_ready(f'http://127.0.0.1:{TODO_PORT}/openapi.json')
+    wait_ready(f'http://127.0.0.1:{GATEWAY_PORT}/gateway/stats')
+    return processes
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results: dict, baseline: dict, max_regression: float) -> list[str]:
+    found = []
+    for name, r in results['scenarios'].items():
+        b = baseline.get('scenarios', {}).get(name)
+        if b is None or not r['requests'] or not b['requests']:
+            continue
+        if r['rps'] < b['rps'] * (1 - max_regression):
+            found.append(f"{name}: throughput {b['rps']:.0f} -> {r['rps']:.0f} rps")
+        if r['p99_ms'] > b['p99_ms'] * (1 + max_regression):
+            found.append(f"{name}: p99 {b['p99_ms']:.2f} -> {r['p99_ms']:.2f} ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gateway load test against stub upstreams')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='can repeat, all by default')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds measured per scenario')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds before measuring starts')
+    parser.add_argument('--users', type=int, default=100, help='distinct tokens of authorized requests')
+    parser.add_argument('--upstream-delay-ms', type=float, default=0)
+    parser.add_argument('--workers', type=int, default=0, help='run gateway with python -m app.serve')
+    parser.add_argument('--gateway-url', help='load already running gateway with the same policies and secret')
+    parser.add_argument('--accept-encoding', default='identity', help='Accept-Encoding of every request, e.g. gzip')
+    parser.add_argument('--output', default='load-results.json')
+    parser.add_argument('--baseline', help='results of earlier run to compare with')
+    parser.add_argument('--max-regression', type=float, default=0.15, help='allowed relative drop or growth')
+    args = parser.parse_args()
+
+    with open(f'{args.output}.log', 'w') as log:
+        processes = [] if args.gateway_url else start_stack(args, log)
+        try:
+            scenarios = asyncio.run(run_all(args, args.gateway_url or f'http://127.0.0.1:{GATEWAY_PORT}'))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'users': args.users,
+            'workers': args.workers,
+            'upstream_delay_ms': args.upstream_delay_ms,
+            'accept_encoding': args.accept_encoding,
+        },
+        'scenarios': scenarios,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=4)
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        # runs from before the setting was recorded used httpx default
+        baseline_encoding = baseline.get('meta', {}).get('accept_encoding', 'gzip, deflate')
+        if baseline_encoding != args.accept_encoding:
+            print(f'  WARNING baseline requested Accept-Encoding: {baseline_encoding}, this run {args.accept_encoding}, '
+                  f'received bytes are not comparable')
+        found = regressions(results, baseline, args.max_regression)
+        for line in found:
+            print(f'  REGRESSION {line}')
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
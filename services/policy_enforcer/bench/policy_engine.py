@@ -0,0 +1,237 @@
+'''
+Equivalence check and microbenchmark of compiled policy engine against casbin.
+
+Every request of a generated corpus is decided by casbin.Enforcer and by
+CompiledEnforcer built from the same model and policies, results (or raised
+exception types) have to be the same, as do decisions served by DecisionCache. Requests of subjects with complete claims
+must mostly be decided by compiled predicates, not by casbin fallback.
+Then both are timed without decision cache:
+    python -m bench.policy_engine
+    python -m bench.policy_engine --config policies.yaml --iterations 20000
+
+Exits with status 1 when any decision (cached ones included) differs or too few are made by compiled predicates.
+'''
+import argparse
+import itertools
+import logging
+import sys
+import time
+
+import casbin
+import yaml
+
+from app.policies.compiled import CompiledEnforcer
+from app.policies.decision_cache import DecisionCache
+from app.policies.config import PoliciesConfig
+
+MODEL = '''
+[request_definition]
+r = sub, obj, act
+
+[policy_definition]
+p = sub_rule, obj, act
+
+[policy_effect]
+e = some(where (p.eft == allow))
+
+[matchers]
+m = eval(p.sub_rule) && keyMatch(r.obj, p.obj) && regexMatch(r.act, p.act)
+'''
+
+# rules exercising what casbin eval() accepts, including results casbin rejects
+SYNTHETIC_RULES = [
+    ('r.sub.group_id == 1', '/groups*', '(GET)|(POST)|(PUT)|(DELETE)'),
+    ('r.sub.group_id > -1', '/todo*', '(GET)|(POST)|(PUT)|(DELETE)|(PATCH)'),
+    ('r.sub.group_id >= 0 && r.sub.group_id < 2', '/users/*', '(GET)|(PATCH)'),
+    ('0 < r.sub.group_id <= 2', '/reports', 'GET'),
+    ('r.sub.role in ("admin", "owner")', '/admin/*', '.*'),
+    ('r.sub.role not in ["guest"] || r.sub.group_id == 1', '/tickets/*', 'POST'),
+    ('not r.sub.banned', '/profile', 'GET'),
+    ('r.sub.score', '/score/*', 'GET'),
+    ('r.sub.group_id', '/raw/*', 'GET'),
+    ('r.sub.name == "r.sub"', '/names', 'GET'),
+    ('r.obj == "/exact" && r.act == "GET"', '/exact', 'GET'),
+    ('r.sub.group_id is None', '/anonymous', 'GET'),
+    ('-r.sub.group_id > 0', '/negative', 'GET'),
+    ('r.sub.group_id == 1 if r.sub.role == "admin" else r.sub.group_id > 5', '/conditional', 'GET'),
+]
+# ways casbin lets a rule read the subject besides r.sub.<claim>, each one alone in its suite
+# so claims read other ways are not covered up by the rest
+SUBJECT_ACCESS_RULES = {
+    'r_sub claims': [('r_sub.group_id == 1', '/groups*', '(GET)|(POST)'), ('r_sub.role == "admin"', '/admin/*', '.*')],
+    'r.sub methods': [('r.sub.get("group_id") == 1', '/groups*', '(GET)|(POST)')],
+    'r.sub subscript': [('r.sub["group_id"] == 1', '/groups*', '(GET)|(POST)')],
+}
+UNSUPPORTED_RULES = [
+    ('r.sub.group_id != 1', '/not-equal', 'GET'),
+    ('r.sub.group_id + 1 > 1', '/arithmetic', 'GET'),
+    ('keyMatch(r.obj, "/x*")', '/function', 'GET'),
+]
+
+# every claim synthetic rules read, well typed, so decisions come from compiled predicates
+COMPLETE_SUBJECTS = [
+    {'sub': '10', 'group_id': 1, 'role': 'admin', 'banned': False, 'score': 1.5, 'name': 'r.sub'},
+    {'sub': '11', 'group_id': 2, 'role': 'owner', 'banned': True, 'score': 0.0, 'name': 'r_sub'},
+    {'sub': '12', 'group_id': 6, 'role': 'user', 'banned': False, 'score': 0.0, 'name': 'x'},
+    {'sub': '13', 'group_id': -1, 'role': 'guest', 'banned': True, 'score': 2.0, 'name': ''},
+    {'sub': '14', 'group_id': 1, 'role': 'guest', 'banned': False, 'score': -1.0, 'name': 'r.sub'},
+    {'sub': '15', 'group_id': 7, 'role': 'admin', 'banned': True, 'score': 0.5, 'name': 'admin'},
+]
+# incomplete or oddly typed claims, mostly decided by casbin fallback
+PARTIAL_SUBJECTS = [
+    {'sub': '1', 'group_id': 1, 'role': 'admin'},
+    {'sub': '2', 'group_id': 0, 'role': 'user', 'banned': False, 'score': 0.0},
+    {'sub': '3', 'group_id': -1, 'role': 'guest', 'banned': True, 'score': 1.5},
+    {'sub': '4', 'group_id': 2, 'name': 'r_sub'},
+    {'sub': '5', 'group_id': 6, 'role': 'owner', 'score': 0},
+    {'sub': '6', 'group_id': None},
+    {'sub': '7', 'group_id': '1'},
+    {'sub': '8'},
+]
+SUBJECTS = COMPLETE_SUBJECTS + PARTIAL_SUBJECTS
+# part of COMPLETE_SUBJECTS requests compiled policies have to decide without casbin fallback
+MIN_COMPILED_SHARE = 0.9
+METHODS = ['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS']
+
+
+def build_enforcer(model: str, policies: list[tuple[str, str, str]]) -> casbin.Enforcer:
+    enforcer = casbin.Enforcer(casbin.Enforcer.new_model(text=model))
+    enforcer.add_policies([list(p) for p in policies])
+    return enforcer
+
+
+def load_config(path: str) -> tuple[str, list[tuple[str, str, str]]]:
+    with open(path) as file:
+        config = PoliciesConfig(**yaml.safe_load(file))
+    return config.model, [(str(p.rule), p.resource, p.methods) for p in config.policies if not p.white_list]
+
+
+def resources_for(policies: list[tuple[str, str, str]]) -> list[str]:
+    resources = {'/', '/other', '/exact', '/exactly'}
+    for _, pattern, _ in policies:
+        base = pattern.split('*')[0]
+        resources.update({base, base + '1', base.rstrip('/'), base + 'x/y', base[:-1] if len(base) > 1 else base})
+    return sorted(resources)
+
+
+def decide(enforce, sub: dict, obj: str, act: str):
+    try:
+        return enforce(sub, obj, act)
+    except Exception as E:
+        return type(E).__name__
+
+
+def check_equivalence(name: str, model: str, policies: list[tuple[str, str, str]]) -> int:
+    '''
+    Number of failures: differing decisions, plus one when compiled predicates decided
+    less than MIN_COMPILED_SHARE of requests of subjects with complete claims
+    '''
+    casbin_enforcer = build_enforcer(model, policies)
+    compiled = CompiledEnforcer(build_enforcer(model, policies))
+
+    mismatches, complete_fallbacks = 0, 0
+    for subjects in (COMPLETE_SUBJECTS, PARTIAL_SUBJECTS):
+        for sub, obj, act in itertools.product(subjects, resources_for(policies), METHODS):
+            expected = decide(casbin_enforcer.enforce, sub, obj, act)
+            actual = decide(compiled.enforce, sub, obj, act)
+            # casbin errors are re-raised by compiled engine fallback, so types match
+            if expected != actual:
+                mismatches += 1
+                print(f'  MISMATCH {sub} {obj} {act}: casbin={expected} compiled={actual}')
+        if subjects is COMPLETE_SUBJECTS:
+            complete_fallbacks = compiled.fallbacks
+
+    requests = len(SUBJECTS) * len(resources_for(policies)) * len(METHODS)
+    complete = len(COMPLETE_SUBJECTS) * len(resources_for(policies)) * len(METHODS)
+    decided = requests - compiled.fallbacks if compiled.compiled else 0
+    complete_decided = complete - complete_fallbacks if compiled.compiled else 0
+    print(
+        f'{name}: {requests} requests, {mismatches} mismatches, {decided} decided by compiled predicates '
+        f'({complete_decided} of {complete} with complete claims), {compiled.stats()}'
+    )
+    # equivalence proves little when casbin fallback decides nearly everything
+    if compiled.compiled and complete_decided < MIN_COMPILED_SHARE * complete:
+        print(f'  TOO FEW COMPILED DECISIONS: {complete_decided} of {complete}, expected at least {MIN_COMPILED_SHARE:.0%}')
+        return mismatches + 1
+    return mismatches
+
+
+def check_decision_cache(name: str, model: str, policies: list[tuple[str, str, str]]) -> int:
+    '''
+    Number of decisions of DecisionCache (over casbin and compiled engines) differing from casbin.
+    Subjects take turns on every resource and method, so a key missing some claim serves
+    a decision cached for one subject to another
+    '''
+    casbin_enforcer = build_enforcer(model, policies)
+    requests = list(itertools.product(resources_for(policies), METHODS, SUBJECTS))
+    expected = [decide(casbin_enforcer.enforce, sub, obj, act) for obj, act, sub in requests]
+
+    mismatches = 0
+    for engine in ('casbin', 'compiled'):
+        enforcer = build_enforcer(model, policies)
+        cache = DecisionCache(enforcer, 100000, 3600, CompiledEnforcer(enforcer) if engine == 'compiled' else None)
+        for (obj, act, sub), want in zip(requests, expected):
+            got = decide(cache.enforce, sub, obj, act)
+            if got != want:
+                mismatches += 1
+                print(f'  CACHE MISMATCH ({engine}) {sub} {obj} {act}: casbin={want} cached={got}')
+    print(f'{name}: decision cache {mismatches} mismatches')
+    return mismatches
+
+
+def benchmark(name: str, model: str, policies: list[tuple[str, str, str]], iterations: int) -> None:
+    casbin_enforcer = build_enforcer(model, policies)
+    compiled = CompiledEnforcer(build_enforcer(model, policies))
+    # only requests casbin decides without raising, errors would dominate timing
+    requests = [
+        (sub, obj, act)
+        for sub, obj, act in itertools.product(SUBJECTS, resources_for(policies), ['GET', 'POST'])
+        if isinstance(decide(casbin_enforcer.enforce, sub, obj, act), bool)
+    ]
+    if not requests:
+        return
+
+    results = {}
+    for engine, enforce in (('casbin', casbin_enforcer.enforce), ('compiled', compiled.enforce)):
+        started = time.perf_counter()
+        for i in range(iterations):
+            sub, obj, act = requests[i % len(requests)]
+            enforce(sub, obj, act)
+        results[engine] = (time.perf_counter() - started) / iterations * 1e6
+
+    print(
+        f"{name}: casbin {results['casbin']:.2f} us/decision, compiled {results['compiled']:.2f} us/decision, "
+        f"{results['casbin'] / results['compiled']:.1f}x"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compiled policy engine equivalence check and benchmark')
+    parser.add_argument('--config', action='append', default=[], help='policies.yaml to check, can repeat')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    # casbin logs every decision
+    logging.disable(logging.CRITICAL)
+
+    suites = [
+        ('synthetic', MODEL, SYNTHETIC_RULES),
+        ('synthetic with unsupported rules', MODEL, SYNTHETIC_RULES + UNSUPPORTED_RULES),
+        ('keyMatch first', MODEL.replace(
+            'eval(p.sub_rule) && keyMatch(r.obj, p.obj)', 'keyMatch(r.obj, p.obj) && eval(p.sub_rule)'
+        ), SYNTHETIC_RULES),
+    ]
+    suites += [(name, MODEL, rules) for name, rules in SUBJECT_ACCESS_RULES.items()]
+    for path in args.config or ['policies.yaml']:
+        suites.append((path, *load_config(path)))
+
+    failures = sum(check_equivalence(name, model, policies) for name, model, policies in suites)
+    failures += sum(check_decision_cache(name, model, policies) for name, model, policies in suites)
+    for name, model, policies in suites:
+        benchmark(name, model, policies, args.iterations)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
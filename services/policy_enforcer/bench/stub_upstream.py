@@ -0,0 +1,119 @@
+'''
+Stub upstream instance for trying gateway locally without databases.
+
+Run several instances and list them as entrypoints of one service:
+    python -m bench.stub_upstream --port 5002 --name todo-1
+    python -m bench.stub_upstream --port 5012 --name todo-2
+
+POST /stub/fail makes instance fail health checks, POST /stub/recover brings it back.
+--body-bytes pads responses to about that size, ?stream=<bytes> in query makes
+response that long and sent in chunks without Content-Length.
+With --server hypercorn instance also accepts HTTP/2 without TLS (h2c), as upstream services do.
+'''
+import argparse
+import asyncio
+import json
+import urllib.parse
+
+import uvicorn
+
+
+class StubUpstream:
+    def __init__(self, name: str, delay: float, body_bytes: int = 0) -> None:
+        self.name: str = name
+        self.delay: float = delay
+        self.body_bytes: int = body_bytes
+        self.failing: bool = False
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        path, method = scope['path'], scope['method']
+        if path == '/stub/fail' and method == 'POST':
+            self.failing = True
+        elif path == '/stub/recover' and method == 'POST':
+            self.failing = False
+
+        if path == '/openapi.json':
+            status = 503 if self.failing else 200
+            payload = {'openapi': '3.1.0', 'info': {'title': self.name, 'version': '0.0.1'}, 'paths': {}}
+        else:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            status = 200
+            payload = {'instance': self.name, 'method': method, 'path': path, 'received': len(body)}
+            stream = urllib.parse.parse_qs(scope['query_string'].decode()).get('stream')
+            if stream:
+                await self.stream(send, int(stream[0]))
+                return
+            if self.body_bytes:
+                payload['data'] = 'x' * max(self.body_bytes - len(json.dumps(payload)) - 10, 0)
+
+        await self.respond(send, status, payload)
+
+    async def stream(self, send, size: int, chunk_size: int = 16384) -> None:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'application/octet-stream'), (b'x-upstream-instance', self.name.encode())],
+        })
+        chunk = b'x' * chunk_size
+        while size > 0:
+            await send({'type': 'http.response.body', 'body': chunk[:size], 'more_body': True})
+            size -= chunk_size
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def respond(self, send, status: int, payload: dict) -> None:
+        content = json.dumps(payload).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(content)).encode()),
+                (b'x-upstream-instance', self.name.encode()),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': content})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub upstream instance')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--name', default='stub')
+    parser.add_argument('--delay-ms', type=float, default=0, help='delay before every response')
+    parser.add_argument('--body-bytes', type=int, default=0, help='approximate size of json responses')
+    parser.add_argument('--server', choices=['uvicorn', 'hypercorn'], default='uvicorn')
+    args = parser.parse_args()
+
+    app = StubUpstream(args.name, args.delay_ms / 1000, args.body_bytes)
+    if args.server == 'hypercorn':
+        serve_hypercorn(app, args.host, args.port)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+
+def serve_hypercorn(app, host: str, port: int) -> None:
+    # imported here, only needed for HTTP/2 upstream
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f'{host}:{port}']
+    config.loglevel = 'WARNING'
+    # same as hypercorn.toml of services, default closes connection after 1000 requests
+    config.keep_alive_max_requests = 1000000
+    asyncio.run(serve(app, config))
+
+
+if __name__ == '__main__':
+    main()
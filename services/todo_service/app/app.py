@@ -3,35 +3,36 @@ import logging, typing, jwt
 
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import OAuth2PasswordBearer
 
 from contextlib import asynccontextmanager
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
+from .logs import AccessLogMiddleware, setup_logging
 from . import config, schemas, crud
 from .jwtbearer import JWTBearer
+from .pagination import InvalidCursor, page_size
 from .database import get_async_session, models, DB_INITIALIZER
 
 
 
 #init logger
 logger = logging.getLogger("user-service")
-logging.basicConfig(
-    level=20,
-    format="%(levelname)-9s %(message)s"
-)
 
 #load config
 cfg: config.Config = config.load_config(_env_file='.env')
+setup_logging(cfg.LOG_LEVEL, cfg.LOG_SAMPLE_RATE)
+#dsn carries database password
 logger.info(
     'Service configuration loaded:\n' +
-    f'{cfg.model_dump_json(by_alias=True, indent=4)}'
+    f'{cfg.model_dump_json(by_alias=True, indent=4, exclude={"PG_ASYNC_DSN"})}'
 )
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    logger.info(f"Database initialization...{cfg.PG_ASYNC_DSN.unicode_string()}")
+    logger.info("Database initialization...")
     await DB_INITIALIZER.init_db(
         cfg.PG_ASYNC_DSN.unicode_string()
     )
@@ -45,6 +46,10 @@ app = FastAPI(
     title='Todo service',
     lifespan=lifespan
 )
+
+#compressed only for clients (the gateway) accepting gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(AccessLogMiddleware)
         
 
 #redirect
@@ -59,16 +64,48 @@ async def docs():
 @app.get("/todo/sections", 
          summary="Get all sections",
          tags=["todo"],
-         response_model=list[schemas.Section]
+         response_model=list[schemas.Section] | schemas.SectionPage
 )
-async def get_sections(skip: int = 0, limit: int = 100, 
+async def get_sections(skip: int = 0, limit: int = 100, cursor: typing.Optional[str] = None,
                        session: AsyncSession = Depends(get_async_session), 
                        token_data: schemas.TokenData = Depends(JWTBearer())):
     '''
-    Get all sections
+    Get all sections.
+
+    With `cursor` (empty for the first page) returns page of sections with `next_cursor`,
+    otherwise plain list from `skip` on
+    '''
+    limit = page_size(limit)
+    if cursor is None:
+        return await crud.get_sections(session, token_data.sub, skip, limit)
+
+    try:
+        sections, next_cursor = await crud.get_sections_page(session, token_data.sub, cursor, limit)
+    except InvalidCursor:
+        return JSONResponse({"message": "Invalid cursor"}, status_code=400)
+    return {"items": sections, "next_cursor": next_cursor}
+
+@app.get("/todo/board", 
+         summary="Get sections with their tasks",
+         tags=["todo"],
+         response_model=schemas.Board
+)
+async def get_board(cursor: str = "", limit: int = 100, task_limit: int = 20,
+                    session: AsyncSession = Depends(get_async_session), 
+                    token_data: schemas.TokenData = Depends(JWTBearer())):
     '''
+    Get page of sections, each one with its first `task_limit` tasks.
+    Rest of tasks of a section are read from its tasks endpoint with `next_tasks_cursor`
+    '''
+    try:
+        sections, next_cursor = await crud.get_board(
+            token_data.sub, session, cursor, page_size(limit), page_size(task_limit)
+        )
+    except InvalidCursor:
+        return JSONResponse({"message": "Invalid cursor"}, status_code=400)
 
-    return await crud.get_sections(session, token_data.sub, skip, min(limit, 100))
+    #built by crud in response shape already, so it is not validated again task by task
+    return JSONResponse({"sections": sections, "next_cursor": next_cursor})
 
 @app.get("/todo/sections/{section_id}", 
          summary="Get one section by ID",
@@ -175,15 +212,51 @@ async def upload_new_task(section_id: int,
 @app.get("/todo/sections/{section_id}/tasks", 
          summary="Get all tasks",
          tags=["todo"],
-         response_model=list[schemas.Task]
+         response_model=list[schemas.Task] | schemas.TaskPage
 )
-async def get_tasks(section_id: int, skip: int = 0, limit: int = 100,
+async def get_tasks(section_id: int, skip: int = 0, limit: int = 100, cursor: typing.Optional[str] = None,
                     session: AsyncSession = Depends(get_async_session), 
                     token_data: schemas.TokenData = Depends(JWTBearer())):
     '''
-    Get all tasks
+    Get all tasks.
+
+    With `cursor` (empty for the first page) returns page of tasks with `next_cursor`,
+    otherwise plain list from `skip` on
     '''
-    return await crud.get_tasks(section_id=section_id, owner=token_data.sub, session=session, skip=skip, limit=limit)
+    if cursor is None:
+        return await crud.get_tasks(section_id=section_id, owner=token_data.sub, session=session, skip=skip, limit=max(limit, 0))
+
+    try:
+        tasks, next_cursor = await crud.get_tasks_page(
+            section_id=section_id, owner=token_data.sub, session=session, cursor=cursor, limit=page_size(limit)
+        )
+    except InvalidCursor:
+        return JSONResponse({"message": "Invalid cursor"}, status_code=400)
+    return {"items": tasks, "next_cursor": next_cursor}
+
+@app.post("/todo/sections/{section_id}/tasks:batch", 
+         summary="Create, update and delete tasks of section at once",
+         tags=["todo"],
+         response_model=schemas.TaskBatchResponse
+)
+async def batch_tasks(section_id: int,
+                      batch: schemas.TaskBatch,
+                      session: AsyncSession = Depends(get_async_session), 
+                      token_data: schemas.TokenData = Depends(JWTBearer())):
+    '''
+    Apply operations in one transaction. Update changes only fields sent, as PATCH does.
+    Results come in order of operations, with status 404 for tasks not in section
+    '''
+    if len(batch.operations) > cfg.TASK_BATCH_MAX_OPERATIONS:
+        return JSONResponse(
+            {"message": f"Batch can have at most {cfg.TASK_BATCH_MAX_OPERATIONS} operations"}, status_code=413
+        )
+
+    results = await crud.apply_task_batch(section_id, batch, token_data.sub, session)
+    if results is None:
+        return JSONResponse({"message": "Section not found"}, status_code=400)
+
+    return {"results": results}
 
 @app.get("/todo/sections/{section_id}/tasks/{task_id}", 
          summary="Get task by ID",
@@ -214,7 +287,7 @@ async def update_task(section_id: int,
                         session: AsyncSession = Depends(get_async_session), 
                         token_data: schemas.TokenData = Depends(JWTBearer())):
     '''
-    Update existing task
+    Update existing task, name, description and completed missing in request are set to their defaults
     '''
 
     task = await crud.update_task(section_id, task_id, task_update, token_data.sub, session)
@@ -223,6 +296,26 @@ async def update_task(section_id: int,
 
     return JSONResponse({"message": "Task or section not found"}, status_code=400)
 
+@app.patch("/todo/sections/{section_id}/tasks/{task_id}", 
+         summary="Edit some fields of task",
+         tags=["todo"],
+         response_model=schemas.Task
+)
+async def patch_task(section_id: int,
+                        task_id: int,
+                        task_patch: schemas.TaskPatch,
+                        session: AsyncSession = Depends(get_async_session), 
+                        token_data: schemas.TokenData = Depends(JWTBearer())):
+    '''
+    Update only fields present in request, others are left as they are
+    '''
+
+    task = await crud.update_task(section_id, task_id, task_patch, token_data.sub, session)
+    if task:
+        return task
+
+    return JSONResponse({"message": "Task or section not found"}, status_code=400)
+
 @app.delete("/todo/sections/{section_id}/tasks/{task_id}", 
          summary="Delete task",
          tags=["todo"]
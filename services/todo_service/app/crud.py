@@ -1,10 +1,21 @@
 import datetime
 
+from sqlalchemy import DateTime, Integer, String, cast, column, delete, insert, literal, true, update, values
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
 from . import schemas
 from .database import models
+from .pagination import encode_cursor, keyset_page
+
+#objects already loaded in session get state of returned rows, without extra SELECT on postgres
+RETURNING_OPTIONS = {"synchronize_session": "fetch"}
+
+def owned_section(section_id: int, owner: str):
+    '''
+    Subquery of section id if section belongs to owner, ownership is checked in the statement using it
+    '''
+    return select(models.Section.id).where(models.Section.owner == owner, models.Section.id == section_id)
 
 async def get_section(owner: str, section_id: int, session: AsyncSession) -> models.Section | None:
     query = select(models.Section).where(models.Section.owner == owner, models.Section.id == section_id)
@@ -12,19 +23,22 @@ async def get_section(owner: str, section_id: int, session: AsyncSession) -> mod
     return query_result
 
 async def update_section(section_id: int, new_section: schemas.SectionUpdate, owner:str, session: AsyncSession) -> models.Section | None:
-    section = await get_section(owner=owner, section_id=section_id, session=session)
-    if section:
-        section.name = new_section.name
-        await session.commit()
-        return section
-    else:
-        return None
+    query = update(models.Section).where(
+        models.Section.owner == owner, models.Section.id == section_id
+    ).values(name=new_section.name).returning(models.Section)
+    section = (await session.execute(query, execution_options=RETURNING_OPTIONS)).scalars().one_or_none()
+    await session.commit()
+    return section
 
 async def get_sections(session: AsyncSession, owner:str, skip: int = 0, limit: int = 100) -> list[models.Section]:
-    query = select(models.Section).offset(skip).limit(limit).where(models.Section.owner == owner)
+    query = select(models.Section).where(models.Section.owner == owner).order_by(models.Section.id).offset(skip).limit(limit)
     query_result = (await session.execute(query)).scalars().all()
     return query_result
 
+async def get_sections_page(session: AsyncSession, owner: str, cursor: str, limit: int = 100) -> tuple[list[models.Section], str | None]:
+    query = select(models.Section).where(models.Section.owner == owner)
+    return await keyset_page(session, query, models.Section.id, cursor, limit)
+
 async def create_section(section:schemas.SectionCreate, owner:str, session: AsyncSession) -> models.Section:
     new_section = models.Section(
         name=section.name,
@@ -35,17 +49,75 @@ async def create_section(section:schemas.SectionCreate, owner:str, session: Asyn
     return new_section
 
 async def delete_section(section_id: int, owner: str, session: AsyncSession) -> bool:
-    section = await get_section(owner=owner, section_id=section_id, session=session)
-    if not section:
-        return False
-    await session.delete(section)
+    #tasks are deleted in the same statement, foreign key is checked when it ends
+    deleted_tasks = delete(models.Task).where(
+        models.Task.section_id.in_(owned_section(section_id, owner))
+    ).returning(models.Task.id).cte("deleted_tasks")
+    query = delete(models.Section).where(
+        models.Section.owner == owner, models.Section.id == section_id
+    ).returning(models.Section.id).add_cte(deleted_tasks)
+    deleted = (await session.execute(query)).scalar_one_or_none()
     await session.commit()
-    return True
+    return deleted is not None
 
 async def get_tasks(section_id: int, owner:str, session: AsyncSession, skip = 0, limit = 100) -> list[models.Task]:
-    query = select(models.Task).offset(skip).limit(limit).where(models.Task.section_id == section_id, models.Task.owner == owner)
+    query = select(models.Task).where(
+        models.Task.section_id == section_id, models.Task.owner == owner
+    ).order_by(models.Task.id).offset(skip).limit(limit)
     return (await session.execute(query)).scalars().all()
 
+async def get_tasks_page(section_id: int, owner: str, session: AsyncSession, cursor: str, limit: int = 100) -> tuple[list[models.Task], str | None]:
+    query = select(models.Task).where(models.Task.section_id == section_id, models.Task.owner == owner)
+    return await keyset_page(session, query, models.Task.id, cursor, limit)
+
+
+def board_tasks_query(section_ids: list[int], owner: str, task_limit: int):
+    '''
+    First task_limit + 1 tasks of every section, read through (owner, section_id, id) index
+    by LATERAL subquery per section, so sections with many tasks cost no more than others
+    '''
+    sections = select(models.Section.id).where(
+        models.Section.owner == owner, models.Section.id.in_(section_ids)
+    ).subquery("board_sections")
+    tasks = select(
+        models.Task.id, models.Task.name, models.Task.description, models.Task.completed,
+        models.Task.completed_at, models.Task.created_at, models.Task.section_id,
+    ).where(
+        models.Task.owner == owner, models.Task.section_id == sections.c.id
+    ).order_by(models.Task.id).limit(task_limit + 1).lateral("board_tasks")
+    return select(tasks).select_from(sections.join(tasks, true())).order_by(tasks.c.section_id, tasks.c.id)
+
+async def get_board(owner: str, session: AsyncSession, cursor: str, limit: int = 100, task_limit: int = 20) -> tuple[list[dict], str | None]:
+    '''
+    Page of sections with their first task_limit tasks, in two queries whatever number of sections.
+    Rows are turned into plain dicts, without ORM objects and model validation per task
+    '''
+    sections, next_cursor = await get_sections_page(session, owner, cursor, limit)
+    board = {section.id: {
+        "id": section.id,
+        "name": section.name,
+        "tasks": [],
+        "next_tasks_cursor": None,
+    } for section in sections}
+    if not board:
+        return [], next_cursor
+
+    for row in (await session.execute(board_tasks_query(list(board), owner, task_limit))).mappings():
+        section = board[row["section_id"]]
+        if len(section["tasks"]) == task_limit:
+            #extra row only tells there are more tasks, they are read from tasks endpoint with this cursor
+            section["next_tasks_cursor"] = encode_cursor(section["tasks"][-1]["id"])
+            continue
+        section["tasks"].append({
+            "id": row["id"],
+            "name": row["name"],
+            "description": row["description"],
+            "completed": row["completed"],
+            "completed_at": row["completed_at"].isoformat() if row["completed_at"] else None,
+            "created_at": row["created_at"].isoformat(),
+        })
+    return list(board.values()), next_cursor
+
 
 async def get_task(section_id: int, task_id: int, owner:str, session: AsyncSession) -> models.Task:
     query = select(models.Task).where(
@@ -57,53 +129,137 @@ async def get_task(section_id: int, task_id: int, owner:str, session: AsyncSessi
 
 
 async def create_task(section_id: int, task_create: schemas.TaskCreate, owner: str, session: AsyncSession) -> models.Task:
-    section = await get_section(owner=owner, section_id=section_id, session=session)
-    if not section:
-        return None
+    #inserts nothing when section is not owned by owner
+    row = select(
+        literal(task_create.name, String),
+        literal(task_create.description, String),
+        literal(False),
+        literal(datetime.datetime.now(), DateTime),
+        literal(owner, String),
+        models.Section.id,
+    ).where(models.Section.owner == owner, models.Section.id == section_id)
+    query = insert(models.Task).from_select(
+        ["name", "description", "completed", "created_at", "owner", "section_id"], row
+    ).returning(models.Task)
 
-    task = models.Task(
-        name = task_create.name,
-        description = task_create.description,
-        completed = False,
-        created_at = datetime.datetime.now(),
-        owner = owner,
-        section_id = section.id
-    )
-    
-    session.add(task)
+    task = (await session.execute(query)).scalars().one_or_none()
     await session.commit()
-    await session.refresh(task)
-    
     return task
 
 async def delete_task(section_id: int, task_id:int, owner: str, session: AsyncSession) -> bool:
-    section = await get_section(owner=owner, section_id=section_id, session=session)
-    if not section:
-        return False
-    
-    task = await get_task(section_id, task_id, owner, session)
-    if not task:
-        return False
-
-    await session.delete(task)
+    query = delete(models.Task).where(
+        models.Task.id == task_id,
+        models.Task.owner == owner,
+        models.Task.section_id.in_(owned_section(section_id, owner)),
+    ).returning(models.Task.id)
+    deleted = (await session.execute(query, execution_options=RETURNING_OPTIONS)).scalar_one_or_none()
     await session.commit()
-    return True
+    return deleted is not None
 
 
-async def update_task(section_id: int, task_id: int, task_update: schemas.TaskUpdate, owner: str, session: AsyncSession) -> models.Task:
-    section = await get_section(owner=owner, section_id=section_id, session=session)
-    if not section:
-        return None
-    
-    task = await get_task(section_id, task_id, owner, session)
-    if not task:
-        return None
-    
-    for var, value in vars(task_update).items():
-        setattr(task, var, value) if (value != None) else None
+async def update_task(section_id: int, task_id: int, task_update: schemas.TaskUpdate | schemas.TaskPatch, owner: str,
+                      session: AsyncSession) -> models.Task:
+    '''
+    Update task with one UPDATE ... RETURNING.
+    TaskUpdate sets every field which is not null, TaskPatch only fields sent by client
+    '''
+    if isinstance(task_update, schemas.TaskPatch):
+        changes = task_update.model_dump(exclude_unset=True)
+    else:
+        changes = task_update.model_dump(exclude_none=True)
+    if not changes:
+        return await get_task(section_id, task_id, owner, session)
 
-    session.add(task)
+    query = update(models.Task).where(
+        models.Task.id == task_id,
+        models.Task.owner == owner,
+        models.Task.section_id.in_(owned_section(section_id, owner)),
+    ).values(**changes).returning(models.Task)
+    task = (await session.execute(query, execution_options=RETURNING_OPTIONS)).scalars().one_or_none()
     await session.commit()
-    await session.refresh(task)
-    
     return task
+
+
+async def apply_task_batch(section_id: int, batch: schemas.TaskBatch, owner: str, session: AsyncSession) -> list[dict] | None:
+    '''
+    Apply batch operations in one transaction, one multi-row statement per kind of operation
+    (updates changing different sets of fields go in separate statements).
+    Returns results in order of operations, None if section is not owned by owner
+    '''
+    #section can not be deleted by another transaction until this one commits
+    section_query = owned_section(section_id, owner).with_for_update(read=True)
+    if (await session.execute(section_query)).scalar_one_or_none() is None:
+        return None
+
+    creates = [operation for operation in batch.operations if operation.op == 'create']
+    updates = [operation for operation in batch.operations if operation.op == 'update']
+    deletes = [operation.id for operation in batch.operations if operation.op == 'delete']
+
+    created = []
+    if creates:
+        now = datetime.datetime.now()
+        rows = [{
+            "name": "Task",
+            "description": "",
+            "completed": False,
+            "completed_at": None,
+            **(operation.task.model_dump(exclude_unset=True) if operation.task else {}),
+            "created_at": now,
+            "owner": owner,
+            "section_id": section_id,
+        } for operation in creates]
+        query = insert(models.Task).returning(models.Task, sort_by_parameter_order=True)
+        created = (await session.execute(query, rows)).scalars().all()
+
+    updated = {}
+    for fields, operations in group_by_fields(updates).items():
+        #UPDATE ... FROM (VALUES (id, field, ...), ...) changes every task of the group at once
+        changes = values(
+            column("id", Integer),
+            *(column(field, models.Task.__table__.c[field].type) for field in fields),
+            name="changes",
+        ).data([
+            (operation.id, *(getattr(operation.task, field) for field in fields)) for operation in operations
+        ])
+        query = update(models.Task).where(
+            models.Task.id == changes.c.id,
+            models.Task.owner == owner,
+            models.Task.section_id == section_id,
+        ).values({
+            #column of nulls only is text for postgres
+            field: cast(changes.c[field], models.Task.__table__.c[field].type) for field in fields
+        }).returning(models.Task)
+        for task in (await session.execute(query, execution_options={"synchronize_session": False})).scalars():
+            updated[task.id] = task
+
+    deleted = set()
+    if deletes:
+        query = delete(models.Task).where(
+            models.Task.id.in_(deletes),
+            models.Task.owner == owner,
+            models.Task.section_id == section_id,
+        ).returning(models.Task.id)
+        deleted = set((await session.execute(query, execution_options={"synchronize_session": False})).scalars())
+
+    await session.commit()
+
+    results = []
+    created_tasks = iter(created)
+    for operation in batch.operations:
+        if operation.op == 'create':
+            task = next(created_tasks)
+            results.append({"op": operation.op, "id": task.id, "status": 201, "task": task})
+        elif operation.op == 'update':
+            task = updated.get(operation.id)
+            results.append({"op": operation.op, "id": operation.id, "status": 200 if task else 404, "task": task})
+        else:
+            results.append({"op": operation.op, "id": operation.id, "status": 200 if operation.id in deleted else 404})
+    return results
+
+
+def group_by_fields(operations: list[schemas.TaskBatchOperation]) -> dict[tuple[str, ...], list[schemas.TaskBatchOperation]]:
+    groups = {}
+    for operation in operations:
+        fields = tuple(sorted(operation.task.model_fields_set))
+        groups.setdefault(fields, []).append(operation)
+    return groups
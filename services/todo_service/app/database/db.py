@@ -1,10 +1,12 @@
 from sqlalchemy import inspect
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine, AsyncConnection, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import CreateSchema
 
 from typing import AsyncGenerator
 
+from .migrations import Migration, apply_migrations
+
 class Database_Initializer():
     def __init__(self, base, schema):
         self.base = base
@@ -20,18 +22,26 @@ class Database_Initializer():
             engine, expire_on_commit=False
         )
         async with engine.begin() as connection:
-            #create schema
-            schema = self.get_schema()
+            await self.upgrade(connection)
+            await connection.commit()
 
-            def check_schema(conn):
-                return inspect(conn).has_schema(schema)
+    async def upgrade(self, connection: AsyncConnection) -> list[Migration]:
+        '''
+        Create schema and missing tables, then apply pending migrations
+        '''
+        #create schema
+        schema = self.get_schema()
 
-            if not (await connection.run_sync(check_schema)):
-                await connection.execute(CreateSchema(schema))
+        def check_schema(conn):
+            return inspect(conn).has_schema(schema)
 
-            #create metadata
-            await connection.run_sync(self.base.metadata.create_all)
-            await connection.commit()
+        if not (await connection.run_sync(check_schema)):
+            await connection.execute(CreateSchema(schema))
+
+        #create metadata, tables which already exist are left as they are
+        await connection.run_sync(self.base.metadata.create_all)
+        #so changes of existing tables are made by migrations
+        return await apply_migrations(connection, schema)
     
     @property
     def async_session_maker(self):
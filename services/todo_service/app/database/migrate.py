@@ -0,0 +1,124 @@
+'''
+Schema migrations of todo service, also applied on service start:
+    python -m app.database.migrate            create schema and tables, apply pending migrations
+    python -m app.database.migrate status     show applied and pending migrations
+    python -m app.database.migrate explain    check query plans of crud queries use their indexes
+
+Database is taken from PG_ASYNC_DSN setting, as for the service.
+`explain` exits with status 1 when a query is planned without its index. Planner prefers
+sequential scans of small tables, so they are turned off for the check: it proves the
+index fits the query, not that it is picked for current table sizes.
+'''
+import argparse, asyncio, json, sys
+
+from sqlalchemy import Select, select
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+
+from app import config, crud
+from . import models
+from .db import DB_INITIALIZER
+from .migrations import applied_versions, load_migrations
+
+
+def query_shapes() -> list[tuple[str, Select, str]]:
+    '''
+    Queries of crud with index each one has to use
+    '''
+    owner, section_id, after_id = 'explain@example.com', 1, 0
+    Section, Task = models.Section, models.Task
+    return [
+        (
+            'sections page',
+            select(Section).where(Section.owner == owner, Section.id > after_id).order_by(Section.id).limit(101),
+            'ix_sections_owner_id',
+        ),
+        (
+            'sections offset page',
+            select(Section).where(Section.owner == owner).order_by(Section.id).offset(100).limit(100),
+            'ix_sections_owner_id',
+        ),
+        (
+            'tasks page',
+            select(Task).where(
+                Task.section_id == section_id, Task.owner == owner, Task.id > after_id
+            ).order_by(Task.id).limit(101),
+            'ix_tasks_owner_section_id',
+        ),
+        (
+            'tasks offset page',
+            select(Task).where(Task.section_id == section_id, Task.owner == owner).order_by(Task.id).offset(100).limit(100),
+            'ix_tasks_owner_section_id',
+        ),
+        (
+            'board tasks',
+            crud.board_tasks_query([section_id, section_id + 1], owner, 20),
+            'ix_tasks_owner_section_id',
+        ),
+        (
+            'tasks of section',
+            select(Task).where(Task.section_id == section_id),
+            'ix_tasks_section_id',
+        ),
+    ]
+
+
+def plan_indexes(plan: dict) -> list[tuple[str, str]]:
+    '''
+    (node type, index name) of every index scan in plan tree
+    '''
+    found = []
+    if 'Index Name' in plan:
+        found.append((plan['Node Type'], plan['Index Name']))
+    for child in plan.get('Plans', []):
+        found.extend(plan_indexes(child))
+    return found
+
+
+async def explain(connection: AsyncConnection) -> bool:
+    ok = True
+    await connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+    for name, query, index in query_shapes():
+        sql = str(query.compile(connection.sync_connection, compile_kwargs={'literal_binds': True}))
+        result = (await connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {sql}')).scalar()
+        plan = (json.loads(result) if isinstance(result, str) else result)[0]['Plan']
+        scans = plan_indexes(plan)
+        used = any(scan_index == index for _, scan_index in scans)
+        ok = ok and used
+        print(f"{'ok' if used else 'FAIL':>4}  {name}: {', '.join(f'{t} on {i}' for t, i in scans) or plan['Node Type']}")
+    return ok
+
+
+async def run(command: str, dsn: str) -> int:
+    engine = create_async_engine(dsn)
+    try:
+        async with engine.begin() as connection:
+            if command == 'upgrade':
+                done = await DB_INITIALIZER.upgrade(connection)
+                print(f"Applied {len(done)} migrations" + ''.join(f"\n  {m.version:04d} {m.name}" for m in done))
+                return 0
+
+            if command == 'status':
+                applied = await applied_versions(connection, DB_INITIALIZER.get_schema())
+                for migration in load_migrations():
+                    state = 'applied' if migration.version in applied else 'pending'
+                    print(f"{migration.version:04d} {migration.name:<30} {state:<8} {migration.description}")
+                return 0
+
+            ok = await explain(connection)
+            await connection.rollback()
+            return 0 if ok else 1
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Todo service schema migrations')
+    parser.add_argument('command', nargs='?', default='upgrade', choices=['upgrade', 'status', 'explain'])
+    args = parser.parse_args()
+
+    cfg = config.load_config(_env_file='.env')
+    sys.exit(asyncio.run(run(args.command, cfg.PG_ASYNC_DSN.unicode_string())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''
+Versioned schema changes of todo schema, applied in order by app.database.migrate.
+
+Every module named m<version>_<name>.py holds UPGRADE, list of sql statements
+with {schema} placeholder. Applied versions are never changed, new changes go to a new module.
+'''
+import importlib, logging, pkgutil, typing
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+logger = logging.getLogger(__name__)
+
+VERSION_TABLE = 'schema_version'
+
+
+class Migration(typing.NamedTuple):
+    version: int
+    name: str
+    description: str
+    statements: list[str]
+
+
+def load_migrations() -> list[Migration]:
+    migrations = []
+    for module_info in pkgutil.iter_modules(__path__):
+        prefix, _, name = module_info.name.partition('_')
+        if not prefix.startswith('m') or not prefix[1:].isdigit():
+            continue
+        module = importlib.import_module(f'{__name__}.{module_info.name}')
+        migrations.append(Migration(
+            version=int(prefix[1:]),
+            name=name,
+            description=(module.__doc__ or '').strip(),
+            statements=module.UPGRADE,
+        ))
+    migrations.sort(key=lambda m: m.version)
+    versions = [m.version for m in migrations]
+    if len(set(versions)) != len(versions):
+        raise RuntimeError(f"Duplicate migration versions: {versions}")
+    return migrations
+
+
+async def apply_migrations(connection: AsyncConnection, schema: str) -> list[Migration]:
+    '''
+    Apply migrations missing in schema_version table, in transaction of connection.
+    Advisory lock makes concurrently starting instances apply them once
+    '''
+    await connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": f"{schema}.{VERSION_TABLE}"})
+    await connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {schema}.{VERSION_TABLE} ("
+        "version integer PRIMARY KEY, name varchar NOT NULL, applied_at timestamp NOT NULL DEFAULT now())"
+    ))
+    applied = await applied_versions(connection, schema)
+
+    done = []
+    for migration in load_migrations():
+        if migration.version in applied:
+            continue
+        for statement in migration.statements:
+            await connection.execute(text(statement.format(schema=schema)))
+        await connection.execute(
+            text(f"INSERT INTO {schema}.{VERSION_TABLE} (version, name) VALUES (:version, :name)"),
+            {"version": migration.version, "name": migration.name},
+        )
+        logger.info(f"Schema {schema} migrated to version {migration.version}: {migration.name}")
+        done.append(migration)
+    return done
+
+
+async def applied_versions(connection: AsyncConnection, schema: str) -> set[int]:
+    def has_table(conn):
+        return inspect(conn).has_table(VERSION_TABLE, schema=schema)
+
+    if not await connection.run_sync(has_table):
+        return set()
+    return set((await connection.execute(text(f"SELECT version FROM {schema}.{VERSION_TABLE}"))).scalars())
@@ -0,0 +1,12 @@
+'''
+Indexes for owner scoped queries of sections and tasks
+'''
+
+UPGRADE = [
+    #owner = ? [and id > ?] order by id, name included so sections are read from index only
+    'CREATE INDEX IF NOT EXISTS ix_sections_owner_id ON {schema}.sections (owner, id) INCLUDE (name)',
+    #owner = ? and section_id = ? [and id > ?] order by id
+    'CREATE INDEX IF NOT EXISTS ix_tasks_owner_section_id ON {schema}.tasks (owner, section_id, id)',
+    #foreign key, used by section deletes
+    'CREATE INDEX IF NOT EXISTS ix_tasks_section_id ON {schema}.tasks (section_id)',
+]
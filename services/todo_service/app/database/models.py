@@ -6,7 +6,8 @@ from sqlalchemy import (
     Integer, 
     String,
     DateTime,
-    Boolean
+    Boolean,
+    Index
 )
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -16,7 +17,11 @@ from app.database import db
 
 class Section(db.BASE):
     __tablename__ = 'sections'
-    __table_args__ = {'schema':  db.SCHEMA}
+    #indexes are created by migrations on existing databases, keep them in sync
+    __table_args__ = (
+        Index('ix_sections_owner_id', 'owner', 'id', postgresql_include=['name']),
+        {'schema':  db.SCHEMA},
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
@@ -26,7 +31,11 @@ class Section(db.BASE):
 # Определяем модель сущности Task
 class Task(db.BASE):
     __tablename__ = 'tasks'
-    __table_args__ = {'schema':  db.SCHEMA}
+    __table_args__ = (
+        Index('ix_tasks_owner_section_id', 'owner', 'section_id', 'id'),
+        Index('ix_tasks_section_id', 'section_id'),
+        {'schema':  db.SCHEMA},
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
@@ -0,0 +1,162 @@
+'''
+Json logging through a background writer thread, with access log sampling.
+
+Copied byte for byte into every service (each one is built from its own directory),
+service specifics come in as setup_logging arguments. Change all copies together.
+'''
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import traceback
+
+ACCESS_LOGGER = 'access'
+# attributes every LogRecord has, anything else was passed in extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+_listener: logging.handlers.QueueListener = None
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One json object per line, fields passed in extra= are added as they are
+    '''
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = ''.join(traceback.format_exception(*record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Keeps rate part of info and debug records, warnings and errors are always kept.
+    Set on access logger, the only one logging per request
+    '''
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate: float = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or self.rate >= 1.0 or random.random() < self.rate
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Puts records on the queue as they are, message formatting happens in the writer thread
+    '''
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(level: str = 'INFO', sample_rate: float = 1.0, logger_levels: dict[str, int] = None) -> None:
+    '''
+    Route all logging through a queue to a background thread writing json lines to stderr,
+    so logging from the event loop costs only putting a record on the queue.
+    logger_levels override levels of chatty library loggers
+    '''
+    global _listener
+    handler = LazyQueueHandler(queue.SimpleQueue())
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    access = logging.getLogger(ACCESS_LOGGER)
+    access.addFilter(SamplingFilter(sample_rate))
+    for name, logger_level in (logger_levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    _listener = make_listener(handler)
+    _listener.start()
+    atexit.register(stop_logs)
+    # threads do not survive fork, forked workers get their own writer
+    os.register_at_fork(after_in_child=lambda: restart_listener(handler))
+
+
+def make_listener(handler: logging.handlers.QueueHandler) -> logging.handlers.QueueListener:
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter())
+    return logging.handlers.QueueListener(handler.queue, stream, respect_handler_level=True)
+
+
+def restart_listener(handler: logging.handlers.QueueHandler) -> None:
+    global _listener
+    handler.queue = queue.SimpleQueue()
+    _listener = make_listener(handler)
+    _listener.start()
+
+
+def flush_logs() -> None:
+    '''
+    Write out everything logged so far, called before process exits
+    '''
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+
+
+def stop_logs() -> None:
+    if _listener is not None:
+        _listener.stop()
+
+
+class AccessLogMiddleware:
+    '''
+    Structured access record per request with timing, logged after the last byte is sent.
+    Query strings and headers are left out, they may carry tokens.
+    '''
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.logger: logging.Logger = logging.getLogger(ACCESS_LOGGER)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http' or not self.logger.isEnabledFor(logging.INFO):
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        sent_bytes = 0
+        ttfb = None
+
+        async def send_and_record(message) -> None:
+            nonlocal status, sent_bytes, ttfb
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                ttfb = time.perf_counter() - started
+            elif message['type'] == 'http.response.body':
+                sent_bytes += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            client = scope.get('client')
+            self.logger.info('%s %s %s', scope['method'], scope['path'], status, extra={
+                'method': scope['method'],
+                'path': scope['path'],
+                'status': status,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+                'ttfb_ms': round(ttfb * 1000, 3) if ttfb is not None else None,
+                'bytes': sent_bytes,
+                'client': client[0] if client else None,
+            })
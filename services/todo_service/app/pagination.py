@@ -0,0 +1,56 @@
+import base64, binascii, json
+
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def page_size(limit: int) -> int:
+    '''
+    Requested limit brought to 1..MAX_PAGE_SIZE
+    '''
+    return max(min(limit, MAX_PAGE_SIZE), 1)
+
+
+def encode_cursor(last_id: int) -> str:
+    '''
+    Opaque cursor pointing after row with last_id
+    '''
+    return base64.urlsafe_b64encode(json.dumps({'id': last_id}).encode()).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor: str) -> int | None:
+    '''
+    Id to continue after, None for empty cursor (first page)
+    '''
+    if not cursor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        last_id = data['id']
+    except (binascii.Error, ValueError, TypeError, KeyError) as E:
+        raise InvalidCursor(cursor) from E
+    if not isinstance(last_id, int):
+        raise InvalidCursor(cursor)
+    return last_id
+
+
+async def keyset_page(session: AsyncSession, query: Select, id_column, cursor: str, limit: int) -> tuple[list, str | None]:
+    '''
+    Rows of query ordered by id after the cursor, and cursor of the next page (None on the last one).
+    Reads through the primary key index from the cursor on, so deep pages cost as much as the first
+    '''
+    last_id = decode_cursor(cursor)
+    if last_id is not None:
+        query = query.where(id_column > last_id)
+    #one extra row tells if there is a next page
+    rows = (await session.execute(query.order_by(id_column).limit(limit + 1))).scalars().all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].id)
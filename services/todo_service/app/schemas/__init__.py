@@ -1,15 +1,26 @@
-from .section import Section, SectionCreate, SectionUpdate
-from .task import Task, TaskCreate, TaskUpdate
+from .section import Section, SectionCreate, SectionUpdate, SectionPage, BoardSection, Board
+from .task import Task, TaskCreate, TaskUpdate, TaskPatch, TaskPage
+from .task_batch import TaskBatch, TaskBatchOperation, TaskBatchResult, TaskBatchResponse
 from .token_data import TokenData
 
 __all__ = [
     Section,
     SectionCreate,
     SectionUpdate,
+    SectionPage,
+    BoardSection,
+    Board,
 
     Task, 
     TaskCreate, 
     TaskUpdate,
+    TaskPatch,
+    TaskPage,
+
+    TaskBatch,
+    TaskBatchOperation,
+    TaskBatchResult,
+    TaskBatchResponse,
 
     TokenData,
 ]
\ No newline at end of file
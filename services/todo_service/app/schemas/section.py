@@ -1,4 +1,7 @@
 from pydantic import BaseModel, Field
+import typing
+
+from .task import Task
 
 class SectionCreate(BaseModel):
     name: str = Field(title="Section name")
@@ -9,3 +12,14 @@ class SectionUpdate(SectionCreate):
 class Section(SectionCreate):
     id: int = Field(title="Section ID")
 
+class SectionPage(BaseModel):
+    items: list[Section] = Field(title="Sections of the page")
+    next_cursor: typing.Optional[str] = Field(title="Cursor of the next page, null on the last one", default=None)
+
+class BoardSection(Section):
+    tasks: list[Task] = Field(title="First tasks of the section")
+    next_tasks_cursor: typing.Optional[str] = Field(title="Cursor of the rest of tasks for tasks endpoint, null if all are here", default=None)
+
+class Board(BaseModel):
+    sections: list[BoardSection] = Field(title="Sections of the page with their tasks")
+    next_cursor: typing.Optional[str] = Field(title="Cursor of the next page, null on the last one", default=None)
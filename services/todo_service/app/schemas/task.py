@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 import typing, datetime
 
 class TaskCreate(BaseModel):
@@ -9,8 +9,26 @@ class TaskUpdate(TaskCreate):
     completed: typing.Optional[bool] = Field(title="Task is completed?", default=False)
     completed_at: typing.Optional[datetime.datetime] = Field(title="Task must be completed at?", default=None)
 
+class TaskPatch(BaseModel):
+    '''
+    Partial update, only fields present in request are changed
+    '''
+    name: typing.Optional[str] = Field(title="Task name", default=None)
+    description: typing.Optional[str] = Field(title="Task description", default=None)
+    completed: typing.Optional[bool] = Field(title="Task is completed?", default=None)
+    completed_at: typing.Optional[datetime.datetime] = Field(title="Task must be completed at?", default=None)
+
+    @field_validator('name', 'completed')
+    @classmethod
+    def not_null(cls, value):
+        if value is None:
+            raise ValueError('can not be null')
+        return value
+
 class Task(TaskUpdate):
     id: int = Field(title="Task ID")
     created_at: datetime.datetime = Field(title="Task created at")
-    
-    
\ No newline at end of file
+
+class TaskPage(BaseModel):
+    items: list[Task] = Field(title="Tasks of the page")
+    next_cursor: typing.Optional[str] = Field(title="Cursor of the next page, null on the last one", default=None)
@@ -0,0 +1,38 @@
+from pydantic import BaseModel, Field, model_validator
+import typing
+
+from .task import Task, TaskPatch
+
+class TaskBatchOperation(BaseModel):
+    op: typing.Literal['create', 'update', 'delete'] = Field(title="Operation")
+    id: typing.Optional[int] = Field(title="Task ID, for update and delete", default=None)
+    task: typing.Optional[TaskPatch] = Field(title="Fields of new task, or fields to change", default=None)
+
+    @model_validator(mode='after')
+    def check_operation(self):
+        if self.op == 'create' and self.id is not None:
+            raise ValueError('create can not have id')
+        if self.op != 'create' and self.id is None:
+            raise ValueError(f'{self.op} needs id')
+        if self.op == 'update' and (self.task is None or not self.task.model_fields_set):
+            raise ValueError('update needs fields to change')
+        return self
+
+class TaskBatch(BaseModel):
+    operations: list[TaskBatchOperation] = Field(title="Operations, applied in one transaction")
+
+    @model_validator(mode='after')
+    def check_ids(self):
+        ids = [operation.id for operation in self.operations if operation.id is not None]
+        if len(ids) != len(set(ids)):
+            raise ValueError('every task can be changed once per batch')
+        return self
+
+class TaskBatchResult(BaseModel):
+    op: str = Field(title="Operation")
+    id: typing.Optional[int] = Field(title="Task ID")
+    status: int = Field(title="200 or 201 when applied, 404 when task is not in section")
+    task: typing.Optional[Task] = Field(title="Task after operation", default=None)
+
+class TaskBatchResponse(BaseModel):
+    results: list[TaskBatchResult] = Field(title="Results in order of operations")
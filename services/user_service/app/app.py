@@ -4,11 +4,13 @@ import json
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.middleware.gzip import GZipMiddleware
 
 from contextlib import asynccontextmanager
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
+from .logs import AccessLogMiddleware, setup_logging
 from . import config, schemas, group_crud
 from .utils import HashContext, JWTBearer
 from .database import get_async_session, models, DB_INITIALIZER
@@ -16,16 +18,14 @@ from .database import get_async_session, models, DB_INITIALIZER
 
 #init logger
 logger = logging.getLogger("user-service")
-logging.basicConfig(
-    level=20,
-    format="%(levelname)-9s %(message)s"
-)
 
 #load config
 cfg: config.Config = config.load_config(_env_file='.env')
+setup_logging(cfg.LOG_LEVEL, cfg.LOG_SAMPLE_RATE)
+#dsn carries database password
 logger.info(
     'Service configuration loaded:\n' +
-    f'{cfg.model_dump_json(by_alias=True, indent=4)}'
+    f'{cfg.model_dump_json(by_alias=True, indent=4, exclude={"PG_ASYNC_DSN"})}'
 )
 
 #revoke tokens. you can use redis for that in prod
@@ -33,7 +33,7 @@ hash_context = HashContext(cfg.JWT_SECRET.get_secret_value(), cfg.JWT_REFRESH_SE
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    logger.info(f"Database initialization...{cfg.PG_ASYNC_DSN.unicode_string()}")
+    logger.info("Database initialization...")
     await DB_INITIALIZER.init_db(
         cfg.PG_ASYNC_DSN.unicode_string()
     )
@@ -59,6 +59,10 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+#compressed only for clients (the gateway) accepting gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(AccessLogMiddleware)
+
 #redirect
 @app.get('/', response_class=RedirectResponse, include_in_schema=False)
 async def docs():
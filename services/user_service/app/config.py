@@ -25,6 +25,17 @@ class Config(BaseSettings):
         alias='DEFAULT_GROUPS_CONFIG_PATH'
     )
 
+    LOG_LEVEL: str = Field(
+        default='INFO',
+        alias='LOG_LEVEL'
+    )
+
+    #part of info records kept, warnings and errors are always kept
+    LOG_SAMPLE_RATE: float = Field(
+        default=1.0,
+        alias='LOG_SAMPLE_RATE'
+    )
+
     @classmethod
     def settings_customise_sources(
         cls,